@@ -4,66 +4,152 @@
 
 # Project imports
 import json
+import pickle
 import traceback
 import pandas as pd
 import sys
 import openpyxl
 import requests
 from lxml import etree
-from io import StringIO
-import pyodbc
+from io import StringIO, BytesIO
 from itertools import product
 import argparse
 import sys
 import logging
 import logging.config
-import csv
 import os
 import numpy as np
-from csv import writer
-
-def find_tables(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup, restart):
+import sqlite3
+import threading
+import socket
+import queue
+import time
+import random
+import re
+import gzip
+import hashlib
+import shutil
+import struct
+import codecs
+import resource
+import cProfile
+import pstats
+import tracemalloc
+import datetime
+import requests.adapters
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from contextlib import contextmanager
+
+# pyodbc is only needed by the SQL Server backend of the connection pool. Local stand-ins
+# (see sqlite_backend) work without it, so a missing ODBC driver manager is not fatal on import.
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+# pyarrow is only needed for the parquet staging format
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Errors raised by any of the supported database backends
+DB_ERRORS = (sqlite3.Error,) + ((pyodbc.Error,) if pyodbc is not None else ())
+
+TABLE_LIST_URL = 'https://www2.census.gov/programs-surveys/acs/tech_docs/table_shells/table_lists/2022_DataProductList.xlsx'
+
+# Bump when the layout of the saved table catalog changes, so stale index files are rebuilt
+CATALOG_VERSION = 1
+
+def find_tables():
     # Send an http request to the census website to collect all available table shells
     html_parser = etree.HTMLParser()
-    web_page = requests.get('https://www2.census.gov/programs-surveys/acs/tech_docs/table_shells/table_lists/2022_DataProductList.xlsx', timeout=10)
+    web_page = get_client().get(TABLE_LIST_URL, timeout=10)
     web_page_html_string = web_page.content.decode("utf-8")
     str_io_obj = StringIO(web_page_html_string)
     dom_tree = etree.parse(str_io_obj, parser=html_parser)
     link = dom_tree.xpath('//*[@name="2019 ACS Table List"]/@href')[0]
 
     # Use pandas(pd) to read the csv file of ACS tablenamesinto a dataframe
-    table_lst = pd.read_excel(link, engine='openpyxl')
+    table_lst = pd.read_excel(BytesIO(get_client().get(link).content), engine='openpyxl')
     table_lst['Table Universe'] = table_lst['Table Universe'].str.replace('Universe: ','', regex=True)
 
     # Data cleaning function
     table_lst = clean(table_lst)
 
-    # Export the csv to sql as a table legend 
-    legend = table_lst.to_csv('/HostData/TableLegend.csv', sep=',', encoding='utf-8', index=False)
+    return TableCatalog(table_lst, link)
 
-    # Year splitting function that returns the users' command line input as two numbers.
-    year1, year2 = year_split(years)
 
-    for year in range(year1, year2):
-        # Create schema
-        year = str(year)
-        print(os.getcwd())
-        bulk_insert = "BULK INSERT " + f'[AmericanCommunitySurvey].[{year}_{geo}].[TableLegend]' + "FROM '" + '/HostData/TableLegend.csv' + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
-        sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd) 
+class TableCatalog:
+    # The table list, scraped once and kept as a small index file in /HostData. The full list is the
+    # TableLegend; the tables we download are only the Base detailed tables, which contain the largest
+    # swath of data. These tables begin with a 'B'.
+
+    def __init__(self, legend, source):
+        self.legend = legend
+        self.source = source
+        base = legend[legend['TableID'].str[0] == "B"]
+        self.tables = dict(zip(base['TableID'], base['TableTitle']))
+        self.ids = list(self.tables)
+        self.position = {table: i for i, table in enumerate(self.ids)}
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
 
-    # Transform the table_lst dataframe into a dictionary 
-    table_lst = table_lst.to_dict("records")
+    def __contains__(self, table):
+        return table in self.position
 
-    # The table_lst dictionary is a dict of ALL tables, but we only want the Base detailed tables, 
-    # which contain the largest swath of data. These tables begin with a 'B'. Here we are creating
-    # an empty dict 'tables' to later populate with only the tables beginning with B.
-    global tables
-    tables = {}
+    def starting_at(self, start):
+        # The tables from `start` onwards, in table list order
+        if start not in self.position:
+            raise ValueError(f'{start} is not a B-table in the ACS table list')
+        return self.ids[self.position[start]:]
 
-    # Loop through the larger table list, and append any Base tables to the filtered tables dict
-    for i in table_lst:
-        if i['TableID'][0] == "B": 
-            tables[i['TableID']] = i['TableTitle']
+    def save(self, path):
+        index = {'version': CATALOG_VERSION, 'source': self.source, 'created': time.time(), 'legend': self.legend}
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        # Returns None if there is no index file, or it was written by a different version of this script.
+        # A file pickled by another pandas version, ex. before a container rebuild, can fail to load with
+        # almost any exception; the list is then scraped again rather than stopping the run.
+        try:
+            with open(path, 'rb') as f:
+                index = pickle.load(f)
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.getLogger('api_logger').warning(f'Could not read the table catalog {path}, scraping it again: {e!r}')
+            return None
+        if not isinstance(index, dict) or index.get('version') != CATALOG_VERSION:
+            return None
+        return cls(index['legend'], index['source'])
+
+    def load_legend(self, schemas, ipaddress, uid, pwd):
+        # Export the csv once, then bulk insert it into the TableLegend of every schema, replacing any earlier copy
+        legendpath = os.path.join(_staging_settings['directory'], 'TableLegend.csv')
+        legend = self.legend.to_csv(legendpath, sep=',', encoding='utf-8', index=False)
+        if files_only():
+            return
+        for schema in schemas:
+            sql_server(f'DELETE FROM [AmericanCommunitySurvey].[{schema}].[TableLegend];', 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+            bulk_insert = "BULK INSERT " + f'[AmericanCommunitySurvey].[{schema}].[TableLegend]' + "FROM '" + legendpath + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
+            sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+def resolve_catalog(path, refresh=False):
+    # Use the saved table catalog if there is one, otherwise scrape the table list and save it
+    catalog = None if refresh else TableCatalog.load(path)
+    if catalog is None:
+        catalog = find_tables()
+        catalog.save(path)
+    return catalog
 
 def create_schema(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup, restart):
     logger = logging.getLogger('api_logger')
@@ -90,7 +176,7 @@ def create_schema(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup
             create_legend = "CREATE TABLE "+ f'[AmericanCommunitySurvey].[{year}_{geo}].[TableLegend]' + "(TableName VARCHAR(MAX), TableTitle VARCHAR(MAX), TableUniverse VARCHAR(MAX));"
             sql_server(create_legend, "AmericanCommunitySurvey", ipaddress, uid, pwd)
 
-        except pyodbc.Error as e:
+        except DB_ERRORS as e:
             traceback.print_exc()
             logger.warning(e)
             pass
@@ -107,11 +193,23 @@ def create_db(ipaddress, uid, pwd):
     sql_server(drop_create_db, 'master', ipaddress, uid, pwd)
 
 
-def get_acs_data(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup, restart):
+def plan_units(catalog, years, start, alone):
+    # Every (year, table) pair a run covers.
+    # If the user entered a specific table (optional arg), filter out the one's we've already done. 
+    filtered_tables = catalog.starting_at(start)
+
+    # If the user included the --alone argument in the command line, only the selected table will be downloaded.
+    if not alone:
+        filtered_tables = filtered_tables[:1]
+
+    # If the user enters a range, assign variables to the beginning and end of the range
+    year1, year2 = year_split(years)
+    return list(product(range(year1, year2), filtered_tables))
+
+
+def get_acs_data(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup, restart, catalog, manifest=None, worker=None, incremental=False):
     # Set up logging
     logger = logging.getLogger('api_logger')
-    # If the user entered a specific table (optional arg), filter out the one's we've already done. 
-    filtered_tables = list(tables.keys())[list(tables.keys()).index(start):]
 
     # If the user enters a range, assign variables to the beginning and end of the range
     year1, year2 = year_split(years)
@@ -125,170 +223,1306 @@ def get_acs_data(years, uid, pwd, ipaddress, start, alone, apikey, geo, cleanup,
     if geo == "COUNTY":
         api_geo = "county:*"
 
-    if "BLOCKGROUP" in geo:
-        state_codes = {"01":"AL","02":"AK","03":"AZ","04":"AR","05":"CA","06":"CO","07":"CT","08":"DE","09":"DC","10":"FL","11":"GA","12":"HA","13":"ID","14":"IL","15":"IN","16":"IO","17":"KS","18":"KY","19":"LO","20":"ME","21":"MD","22":"MA","23":"MI","24":"MN","25":"MS","26":"MO","27":"MT","28":"NE","29":"NV","30":"NH","31":"NJ","32":"NM","33":"NY","34":"NC","35":"ND","36":"OH","37":"OK","38":"OR","39":"PN","40":"RI","41":"SC","42":"SD","43":"TN","44":"TX","45":"UT","46":"VT","47":"VA","48":"WA","49":"WV","50":"WI","51":"WY"}    
-        state_code = [key for key,value in state_codes.items() if value == geo.replace("BLOCKGROUP_","")]
-        api_geo = f"block%20group:*&in=state:{state_code[0]}%20county:*"
+    # Every (year, table) pair to download
+    units = plan_units(catalog, years, start, alone)
+
+    client = get_client()
+
+    def fetch(unit, _):
+        year, table = unit
+        if geo == "BLOCKGROUP":
+            # Each state's block groups are cleaned and staged as they arrive, so only the slices in
+            # flight are held in memory. Whatever was staged of a table that fails is deleted. The
+            # staging steps are recorded on their own, so they are left out of the fetch time.
+            staged_table = StagedTable(year, geo, table)
+            start, failed = time.perf_counter(), False
+            try:
+                with profiled('transform', year, geo, table):
+                    digest = fetch_block_groups(year, table, apikey, staged_table, manifest)
+            except BaseException:
+                failed = True
+                staged_table.discard()
+                raise
+            finally:
+                seconds = time.perf_counter() - start - sum(staged_table.clock.seconds.values())
+                fields = {'failed': True} if failed else {}
+                record_metric('fetch', year, geo, table, seconds, bytes=staged_table.bytes, **fields)
+            return None if digest is None else (staged_table, digest)
+        with timed('fetch', year, geo, table) as metric:
+            url = acs_url(year, table, api_geo, apikey)
+            response = client.get(url)
+            metric.update(bytes=len(response.content), status=response.status_code)
+        if response.status_code != 200:
+            logger.warning(f'{response.status_code} {url}')
+            if manifest is not None:
+                manifest.finish(year, geo, table, 'skipped', error=f'HTTP {response.status_code}')
+            return None
+        return response.content, hashlib.sha256(response.content).hexdigest()
+
+    def transform(unit, result):
+        # Parse the payload into a typed dataframe, clean it and write it to the staging directory
+        year, table = unit
+        content, digest = result
+
+        # In incremental mode, leave the table alone if the payload is the same one that was loaded last
+        # time and the table still holds every row of it
+        if incremental and (year, table) in history:
+            loaded_digest, loaded_rows, _ = history[(year, table)]
+            current = long_rows if long_layout() else table_rows
+            if loaded_digest == digest and current(year, geo, table, ipaddress, uid, pwd) == loaded_rows:
+                print(f"{year} - {geo} - {table} unchanged")
+                if isinstance(content, StagedTable):
+                    content.discard()
+                if manifest is not None:
+                    manifest.finish(year, geo, table, 'unchanged')
+                return None
+
+        filename = f'ACS_5Y_Estimates_{year}_{geo}_{table}'
+
+        # Block groups were already staged state by state as they were downloaded
+        if isinstance(content, StagedTable):
+            staged_table = content
+        else:
+            staged_table = StagedTable(year, geo, table)
+            with profiled('transform', year, geo, table):
+                staged_table.add(content)
+        staged_table.record()
+
+        logger.info(f'{year} - {geo} - {table}: {staged_table.rows} rows from {staged_table.bytes} bytes, peak RSS {peak_rss_mb():.0f} MB')
+        return staged_table.df, staged_table.rows, filename, staged_table.staged, staged_table.profile, digest
+
+    def load(unit, result):
+        year, table = unit
+        df, rows, filename, staged, profile, digest = result
+        columns = len(df.columns)
+        complete = rows == len(df)
+        print(f"{year} - {geo} - {table}")
+
+        # With --sink files the staged table is the output. Its rows are recorded as loaded, with no time.
+        if files_only():
+            record_metric('load', year, geo, table, rows=rows, columns=columns, sink='files')
+            if manifest is not None:
+                manifest.finish(year, geo, table, 'done')
+            return
+
+        # Call the ETL function. In incremental mode the table is loaded next to the current one, then swapped in.
+        # In the long layout the table's rows in the fact table are replaced in one transaction instead.
+        with profiled('load', year, geo, table), timed('load', year, geo, table, rows=rows, columns=columns):
+            if long_layout():
+                load_long(df, staged, year, geo, table, complete, ipaddress, uid, pwd)
+            else:
+                # Column types from every row of the table and the variable catalog
+                schema = column_types(profile, variable_types(year, table))
+                if incremental:
+                    staging = f'{table}__staging'
+                    sql_server(f"IF OBJECT_ID('[{year}_{geo}].[{staging}]') IS NOT NULL DROP TABLE [{year}_{geo}].[{staging}]", 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+                    acs_ETL(df, filename, staged.path, year, table, geo, uid=uid, pwd=pwd, ipaddress=ipaddress, target=staging, complete=complete, staged=staged, schema=schema)
+                    swap_table(year, geo, table, staging, ipaddress, uid, pwd)
+                else:
+                    acs_ETL(df, filename, staged.path, year, table, geo, uid=uid, pwd=pwd, ipaddress=ipaddress, complete=complete, staged=staged, schema=schema)
+            record_load(year, geo, table, digest, rows, columns, ipaddress, uid, pwd)
 
-    # If the user included the --alone argument in the command line, only the selected table will be downloaded.
-    if not alone:
-        filtered_tables = [start]
+        # If the user selected --cleanup in the command line options, the staged file will be deleted from the directory.
+        if not cleanup:
+            staged.remove()
+        else:
+            pass
 
-    # Loop through each year in the users defined range, and each table available in the API
-    for year, table in product(range(year1, year2), tables):
-        if table in filtered_tables:
-            # API request to get all zipcode tabulated data for the current year and table
-            print(f"{year} - {geo} - {table}")
+        # Issue SQL checkpoint
+        checkpoint = 'CHECKPOINT'
+        with timed('checkpoint', year, geo, table):
+            sql_server(checkpoint, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
 
-            try:    
-                response = requests.get(f'https://api.census.gov/data/{year}/acs/acs5?get=NAME,group({table})&for={api_geo}&key={apikey}',timeout=100)            
+        if manifest is not None:
+            manifest.finish(year, geo, table, 'done')
 
-                if response.status_code != 200:
-                    logger.warning(f'https://api.census.gov/data/{year}/acs/acs5?get=NAME,group({table})&for={api_geo}&key={apikey}')
-                    pass
-                
-                else:
-                    # If the API call returns data, load it as a json, then use pandas to transform the data into a dataframe
-                    data = response.json()
-                    df = pd.DataFrame(data[1:], columns=data[0])
-                    df = clean(df)
-                    
-                    # This API call is to get the human-readable version of all the columns per table.
-                    response = requests.get(f"https://api.census.gov/data/{year}/acs/acs5/groups/{table}.html")         
-                    cols = pd.read_html(response.text)[0]
-                    variablelabels(cols, table, year, geo)
-
-                    # Write the df to a .csv file in the shared directory, then ETL the file.
-                    path = "/HostData/"
-                    filename = f'ACS_5Y_Estimates_{year}_{geo}_{table}'
-                    filepath = path + filename + ".txt"
-                    df.to_csv(filepath, encoding='utf-8', index=False, sep=',')
-
-                    # Call the ETL function
-                    acs_ETL(df, filename, filepath, year, table, geo, uid=args.uid, pwd=args.pwd, ipaddress=args.ipaddress)
-
-                    # If the user selected --cleanup in the command line options, the .csv file will be deleted from the directory.
-                    if not cleanup:
-                        os.remove(filepath)
-                    else:
-                        pass
+    def failed(unit, stage, error):
+        if manifest is not None:
+            manifest.finish(unit[0], geo, unit[1], 'failed', error=f'{stage}: {error}')
 
-                    # Issue SQL checkpoint
-                    checkpoint = 'CHECKPOINT'
-                    sql_server(checkpoint, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+    # What was loaded by earlier runs, to compare payloads against
+    history = read_load_history(geo, ipaddress, uid, pwd) if incremental else {}
 
+    if manifest is None:
+        # The human-readable version of all the columns, for every table in the run, loaded once per year
+        for year in range(year1, year2):
+            try:
+                variablelabels(year, geo, [table for y, table in units if y == year], ipaddress, uid, pwd)
             except Exception as e:
                 traceback.print_exc()
                 logger.warning(e)
- 
-
-
-def variablelabels(cols, table, year, geo):
-    # For each table, create a crosswalk table for the human-readable version of the column names
-
-    pd.options.mode.chained_assignment = None  # default='warn'
-
-    cols = cols[['Name','Label','Concept','Predicate Type']]
-    cols.insert(0, 'TableName', table)
-    cols = cols.replace('!!', ' ', regex=True)
-    cols['Label'] = cols['Label'].str.title()
-    cols['Label'] = cols['Label'].str.replace(' ', '', regex=True)
-    cols['Predicate Type'] = cols['Predicate Type'].str.replace('string', 'VARCHAR(MAX)', regex=True)
-    cols['Predicate Type'] = cols['Predicate Type'].str.replace('int', 'INTEGER', regex=True)
-
-    cols = cols.rename({'Name': 'ColumnID', 'Predicate Type':'PredicateType'}, axis=1)
-    cols.drop(cols.tail(1).index,inplace=True)
-
-    # Export the csv to sql as a table legend
-    variablelabels_csv = cols.to_csv('/HostData/variablelabels.csv', sep=',', encoding='utf-8', index=False)
-    bulk_insert = "BULK INSERT " + f'[AmericanCommunitySurvey].[{year}_{geo}].[VariableLabels]' + "FROM '" + '/HostData/variablelabels.csv' + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
-    sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd) 
+        feed = ((unit, None) for unit in units)
+    else:
+        # Work through whatever units of this geography no other worker has claimed. The variable labels
+        # were loaded when the manifest was planned.
+        feed = ((unit, None) for unit in manifest.claims(worker, geo, year1, year2))
+
+    # Downloads, cleaning and bulk loads run at the same time on separate worker threads, so the network
+    # and SQL Server are both kept busy. A table that fails at any stage is logged and skipped.
+    # A block group table is already fetched as 51 concurrent requests, so those tables are fetched one at a time
+    pipeline = Pipeline([('fetch', fetch, 1 if geo == "BLOCKGROUP" else client.workers),
+                         ('transform', transform, _pipeline_settings['transform_workers']),
+                         ('load', load, _pipeline_settings['load_workers'])],
+                        buffer=_pipeline_settings['buffer'],
+                        on_error=failed)
+    errors = pipeline.run(feed)
+
+    if errors:
+        logger.warning(f'{len(errors)} {geo} tables failed: ' + ', '.join(f'{year} {table} ({stage})' for (year, table), stage, _ in errors))
+
+
+def acs_url(year, table, api_geo, apikey):
+    # The Census API call for one table, for every geography in the rollup
+    return f'{CENSUS_API}/{year}/acs/acs5?get=NAME,group({table})&for={api_geo}&key={apikey}'
+
+
+# Block groups
+# The API only serves block groups one state at a time. A block group run fetches the state slices of a
+# table concurrently, stages each one as it arrives, and loads them into a single [{year}_BLOCKGROUP] table, partitioned by the state
+# FIPS code, so national queries read one table and queries on a state only read its partition. The
+# FIPS codes below are checked against the state names the API returns for a year before any table
+# of that year is downloaded.
+
+STATES = {
+    'AL': ('01', 'Alabama'), 'AK': ('02', 'Alaska'), 'AZ': ('04', 'Arizona'), 'AR': ('05', 'Arkansas'),
+    'CA': ('06', 'California'), 'CO': ('08', 'Colorado'), 'CT': ('09', 'Connecticut'), 'DE': ('10', 'Delaware'),
+    'DC': ('11', 'District of Columbia'), 'FL': ('12', 'Florida'), 'GA': ('13', 'Georgia'), 'HI': ('15', 'Hawaii'),
+    'ID': ('16', 'Idaho'), 'IL': ('17', 'Illinois'), 'IN': ('18', 'Indiana'), 'IA': ('19', 'Iowa'),
+    'KS': ('20', 'Kansas'), 'KY': ('21', 'Kentucky'), 'LA': ('22', 'Louisiana'), 'ME': ('23', 'Maine'),
+    'MD': ('24', 'Maryland'), 'MA': ('25', 'Massachusetts'), 'MI': ('26', 'Michigan'), 'MN': ('27', 'Minnesota'),
+    'MS': ('28', 'Mississippi'), 'MO': ('29', 'Missouri'), 'MT': ('30', 'Montana'), 'NE': ('31', 'Nebraska'),
+    'NV': ('32', 'Nevada'), 'NH': ('33', 'New Hampshire'), 'NJ': ('34', 'New Jersey'), 'NM': ('35', 'New Mexico'),
+    'NY': ('36', 'New York'), 'NC': ('37', 'North Carolina'), 'ND': ('38', 'North Dakota'), 'OH': ('39', 'Ohio'),
+    'OK': ('40', 'Oklahoma'), 'OR': ('41', 'Oregon'), 'PA': ('42', 'Pennsylvania'), 'RI': ('44', 'Rhode Island'),
+    'SC': ('45', 'South Carolina'), 'SD': ('46', 'South Dakota'), 'TN': ('47', 'Tennessee'), 'TX': ('48', 'Texas'),
+    'UT': ('49', 'Utah'), 'VT': ('50', 'Vermont'), 'VA': ('51', 'Virginia'), 'WA': ('53', 'Washington'),
+    'WV': ('54', 'West Virginia'), 'WI': ('55', 'Wisconsin'), 'WY': ('56', 'Wyoming'),
+}
+
+# Block group tables are created on this partition scheme, one partition per state
+STATE_PARTITION = '[ps_StateFIPS] ([state])'
+
+# State FIPS codes already validated in this run, by year
+_state_fips = {}
+_state_fips_lock = threading.Lock()
+
+def state_fips(year, apikey):
+    # {abbreviation: FIPS code} of the states and DC, in FIPS order. Raises ValueError if the API
+    # lists a different state under any of the codes.
+    with _state_fips_lock:
+        if year in _state_fips:
+            return _state_fips[year]
+
+        response = get_client().get(f'{CENSUS_API}/{year}/acs/acs5?get=NAME&for=state:*&key={apikey}')
+        response.raise_for_status()
+        header, *rows = response.json()
+        names = {row[header.index('state')]: row[header.index('NAME')] for row in rows}
+        for abbreviation, (code, name) in STATES.items():
+            if names.get(code) != name:
+                raise ValueError(f'State FIPS code {code} is {names.get(code)!r} in the {year} API, expected {name} ({abbreviation})')
+
+        _state_fips[year] = {abbreviation: code for abbreviation, (code, name) in sorted(STATES.items(), key=lambda item: item[1][0])}
+        return _state_fips[year]
+
+def fetch_block_groups(year, table, apikey, staged_table, manifest=None):
+    # Download the block groups of every state for one table, at the same time, adding each state to
+    # staged_table as it arrives. Returns a hash over the payloads of all states, or None if the table
+    # has no block group data. Raises if some states failed; the caller discards what was staged.
+    logger = logging.getLogger('api_logger')
+    client = get_client()
+    codes = {acs_url(year, table, f"block%20group:*&in=state:{code}%20county:*", apikey): code for code in state_fips(year, apikey).values()}
+    urls = list(codes)
+
+    def get(url):
+        with timed('fetch_state', year, "BLOCKGROUP", table, state=codes[url]) as metric:
+            response = client.get(url)
+            metric.update(bytes=len(response.content), status=response.status_code)
+        return response
+
+    # States arrive in completion order, so the table's hash is taken over the hash of each state in FIPS order
+    digests, failed = {}, {}
+    for url, response, error in client.map(get, urls):
+        if error is not None:
+            raise error
+        if response.status_code != 200:
+            failed[url] = response.status_code
+            continue
+        digests[url] = hashlib.sha256(response.content).hexdigest()
+        staged_table.add(response.content)
+
+    if len(failed) == len(urls):
+        # Tables that are not published for block groups are refused for every state
+        status = failed[urls[0]]
+        logger.warning(f'{status} {strip_key(urls[0])}')
+        if manifest is not None:
+            manifest.finish(year, "BLOCKGROUP", table, 'skipped', error=f'HTTP {status}')
+        return None
+    if failed:
+        # A partial table is never loaded; the unit fails and can be retried
+        url = next(iter(failed))
+        raise RuntimeError(f'{len(failed)} of {len(urls)} states failed, ex. HTTP {failed[url]} {strip_key(url)}')
+
+    return hashlib.sha256(''.join(digests[url] for url in urls).encode()).hexdigest()
+
+def create_state_partitions(ipaddress, uid, pwd):
+    # The partition function and scheme of the block group tables, if they do not exist yet
+    boundaries = ', '.join(f"'{code}'" for code, name in sorted(STATES.values())[1:])
+    statements = [
+        f"IF NOT EXISTS (SELECT * FROM sys.partition_functions WHERE name = 'pf_StateFIPS') CREATE PARTITION FUNCTION [pf_StateFIPS] (CHAR(2)) AS RANGE RIGHT FOR VALUES ({boundaries});",
+        "IF NOT EXISTS (SELECT * FROM sys.partition_schemes WHERE name = 'ps_StateFIPS') CREATE PARTITION SCHEME [ps_StateFIPS] AS PARTITION [pf_StateFIPS] ALL TO ([PRIMARY]);",
+    ]
+    for statement in statements:
+        sql_server(statement, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+
+# Variable catalogs already downloaded in this run, by year
+_variable_catalogs = {}
+_variable_catalogs_lock = threading.Lock()
+
+def variable_catalog(year):
+    # Every variable of a vintage, from a single call to the API's variables.json, as a crosswalk of
+    # column names to human-readable labels: TableName, ColumnID, Label, Concept, PredicateType
+    with _variable_catalogs_lock:
+        if year in _variable_catalogs:
+            return _variable_catalogs[year]
+
+        response = get_client().get(f"{CENSUS_API}/{year}/acs/acs5/variables.json")
+        response.raise_for_status()
+        variables = pd.DataFrame.from_dict(response.json()['variables'], orient='index')
+        variables = variables.rename_axis('ColumnID').reset_index()
+        for col in ('label', 'concept', 'predicateType', 'group', 'attributes'):
+            if col not in variables.columns:
+                variables[col] = np.nan
+        variables = variables[variables['group'].notna() & (variables['group'] != 'N/A')]
+
+        # Margins of error and annotations are only listed as attributes of their estimate in recent
+        # vintages. Give each attribute its own row, labelled after the estimate it belongs to.
+        attributes = variables[['ColumnID', 'label', 'concept', 'group', 'attributes']].dropna(subset=['attributes'])
+        attributes = attributes.assign(attributes=attributes['attributes'].str.split(',')).explode('attributes')
+        attributes = attributes[attributes['attributes'].str.len() > 0]
+        suffix = attributes['attributes'].str.extract(r'(EA|MA|M)$', expand=False)
+        prefix = suffix.map({'M': 'Margin of Error', 'EA': 'Annotation of Estimate', 'MA': 'Annotation of Margin of Error'})
+        attributes = attributes.assign(ColumnID=attributes['attributes'],
+                                       label=prefix + attributes['label'].str.replace(r'^Estimate', '', regex=True),
+                                       predicateType=np.where(suffix == 'M', 'int', 'string'))
+        attributes = attributes[suffix.notna()]
+
+        cols = pd.concat([variables, attributes], ignore_index=True).drop_duplicates('ColumnID')
+        cols = cols[cols['ColumnID'].str.split('_').str[0] == cols['group']]
+        cols = cols.rename({'group': 'TableName', 'label': 'Label', 'concept': 'Concept', 'predicateType': 'PredicateType'}, axis=1)
+        cols = cols[['TableName', 'ColumnID', 'Label', 'Concept', 'PredicateType']].sort_values(['TableName', 'ColumnID'])
+
+        # Same clean up as the per-table labels used to get, done for the whole vintage at once
+        cols['Label'] = cols['Label'].fillna('').str.replace('!!', ' ', regex=False).str.title().str.replace(' ', '', regex=False)
+        cols['Concept'] = cols['Concept'].fillna('').str.replace('!!', ' ', regex=False)
+        cols['PredicateType'] = cols['PredicateType'].fillna('string').map({'int': 'INTEGER', 'float': 'FLOAT'}).fillna('VARCHAR(MAX)')
+
+        _variable_catalogs[year] = cols.reset_index(drop=True)
+        return _variable_catalogs[year]
+
+def variablelabels(year, geo, tables, ipaddress, uid, pwd):
+    # Create a crosswalk table for the human-readable version of the column names of the given tables,
+    # loaded into the schema's VariableLabels table with one BULK INSERT
+
+    cols = variable_catalog(year)
+    cols = cols[cols['TableName'].isin(tables)]
+
+    # In the long layout the labels are one dimension table for every geography, keyed by year and variable
+    target = f'[AmericanCommunitySurvey].[{year}_{geo}].[VariableLabels]'
+    condition = ''
+    if long_layout():
+        cols = long_labels(cols, year)
+        target = '[AmericanCommunitySurvey].[dbo].[VariableLabels]'
+        condition = f'Year = {int(year)} AND '
+
+    # With --sink files the labels are staged as a dataset of their own, next to the tables
+    if files_only():
+        staging_file(year, geo, 'VariableLabels', dataset='ACS_5Y_VariableLabels').write(cols)
+        return
+
+    # Replace the labels of these tables if an earlier run already loaded them
+    if len(cols) > 0:
+        delete = f"DELETE FROM {target} WHERE {condition}TableName IN ({', '.join(sql_literal(table) for table in tables)});"
+        sql_server(delete, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+    # Each job gets its own staging file, so schemas loading at the same time do not overwrite each other
+    labelpath = os.path.join(_staging_settings['directory'], f'variablelabels_{year}_{geo}_{os.getpid()}.csv')
+    variablelabels_csv = cols.to_csv(labelpath, sep=',', encoding='utf-8', index=False)
+    bulk_insert = "BULK INSERT " + target + " FROM '" + labelpath + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
+    try:
+        sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+    finally:
+        os.remove(labelpath)
+
+
+# Streaming payload parser
+# The API returns a table as one JSON array of rows, the first row being the header. Rather than building
+# the whole list of lists with response.json() and copying it into a dataframe, rows are decoded one at a
+# time and converted into typed columns in small batches: estimate and margin of error columns as 64-bit
+# integers with a null mask (doubles if a column has non-integer values), every other column as strings.
+# The parser reads the downloaded response body in chunks; the body itself is downloaded whole, since it
+# is also what the response cache stores and what the payload hash of the load history is taken over.
+
+ESTIMATE_COLUMN = re.compile(r'^[A-Z0-9]+_\d+[EM]$')
+
+def iter_chunks(content, size=1 << 16):
+    # Slice a payload into chunks without copying it
+    view = memoryview(content)
+    for i in range(0, len(view), size):
+        yield view[i:i + size]
+
+def iter_rows(chunks):
+    # Yield the rows of a JSON array of arrays, decoding from an iterable of byte chunks as needed
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos = '', 0
+    exhausted, opened = False, False
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+
+        if pos < len(buffer):
+            if not opened:
+                if buffer[pos] != '[':
+                    raise ValueError('Census API payload is not a JSON array')
+                opened, pos = True, pos + 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+                yield row
+                continue
+            except json.JSONDecodeError:
+                # Most likely the row is cut off at the end of the chunk; read more and try again
+                if exhausted:
+                    raise
+
+        if exhausted:
+            raise ValueError('Census API payload ended before the closing bracket')
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[pos:] + utf8.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+
+
+class ColumnarTable:
+    # Rows are collected in small batches, and each batch is converted column by column: numeric columns
+    # become arrays with a null mask, so only one batch of raw rows is ever held as python objects.
+    # Census counts are well inside the range a double holds exactly, so columns are converted as doubles
+    # and stored as 64-bit integers if every value is whole.
+
+    def __init__(self, header, batch=4096):
+        self.header = header
+        self.batch = batch
+        self.numeric = [bool(ESTIMATE_COLUMN.match(str(col))) for col in header]
+        self.parts = [[] for _ in header]
+        self.pending = []
+        self.rows = 0
+
+    def append(self, row):
+        self.pending.append(row)
+        self.rows += 1
+        if len(self.pending) >= self.batch:
+            self._flush()
+
+    def _as_strings(self, i):
+        # A column we took for numeric has text in it: keep it as strings from here on
+        strings = []
+        for values, mask in self.parts[i]:
+            strings.extend(None if null else (str(int(value)) if value % 1 == 0 else repr(float(value))) for value, null in zip(values, mask))
+        self.parts[i] = [strings]
+        self.numeric[i] = False
+
+    def _flush(self):
+        if not self.pending:
+            return
+        for i, values in enumerate(zip(*self.pending)):
+            if self.numeric[i]:
+                raw = np.array(values, dtype=object)
+                mask = (raw == None) | (raw == '')
+                raw[mask] = 0
+                try:
+                    self.parts[i].append((raw.astype(np.float64), mask))
+                    continue
+                except (ValueError, TypeError):
+                    self._as_strings(i)
+            self.parts[i].append(list(values))
+        self.pending = []
+
+    def frame(self):
+        self._flush()
+        columns = {}
+        for i, parts in enumerate(self.parts):
+            if not self.numeric[i]:
+                columns[i] = [value for part in parts for value in part]
+                continue
+            if not parts:
+                columns[i] = pd.array([], dtype='Int64')
+                continue
+            mask = np.concatenate([part[1] for part in parts])
+            values = np.concatenate([part[0] for part in parts])
+            if np.all(values % 1 == 0):
+                columns[i] = pd.arrays.IntegerArray(values.astype(np.int64), mask)
+            else:
+                columns[i] = pd.arrays.FloatingArray(values, mask)
+        df = pd.DataFrame(columns, index=pd.RangeIndex(self.rows))
+        df.columns = self.header
+        return df
+
+def stream_frames(chunks, chunk_rows=None):
+    # Yield the payload as typed dataframes of at most chunk_rows rows (one dataframe if chunk_rows is not set)
+    rows = iter_rows(chunks)
+    header = next(rows)
+    table, yielded = ColumnarTable(header), False
+    for row in rows:
+        table.append(row)
+        if chunk_rows and table.rows >= chunk_rows:
+            yield table.frame()
+            table, yielded = ColumnarTable(header), True
+    if table.rows > 0 or not yielded:
+        yield table.frame()
+
+def peak_rss_mb():
+    # Peak resident memory of this process so far, in MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Values the API puts in estimate and margin of error columns in place of a number, to flag that the
+# estimate could not be computed, is top/bottom coded, or is not applicable. The reason is also in the
+# EA/MA annotation columns, so in the data they become NULL.
+CENSUS_SENTINELS = [-999999999, -888888888, -666666666, -555555555, -333333333, -222222222]
+
+def numeric_block(values):
+    # Values of a frame of numeric or text columns as one float64 array, with a mask of the missing cells
+    data = np.empty(values.shape, dtype=np.float64, order='F')
+    missing = np.empty(values.shape, dtype=bool, order='F')
+    text = []
+    for j, (col, dtype) in enumerate(values.dtypes.items()):
+        if pd.api.types.is_numeric_dtype(dtype):
+            data[:, j] = values.iloc[:, j].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            text.append(j)
+    if text:
+        raw = values.iloc[:, text].to_numpy(dtype=object, copy=True)
+        blank = pd.isna(raw) | (raw == '')
+        raw[blank] = 0
+        try:
+            converted = raw.astype(np.float64)
+            converted[blank] = np.nan
+        except (ValueError, TypeError):
+            converted = values.iloc[:, text].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        data[:, text] = converted
+    missing[:] = np.isnan(data)
+    return data, missing
 
 
 def clean(df):
-    # Remove "ZCTA " from the first column values. Ex. "ZCTA 90210" --> "90210"
-    df = df.replace('ZCTA5 ', '', regex=True)   
-
-    # Fill NaN values with nulls
-    df.fillna("",inplace=True)
-
     # Drop duplicated columns
     df = df.loc[:,~df.columns.duplicated()]
 
     # Remove spaces from names
     df.columns = df.columns.str.replace(' ', '')
 
+    # The ACS table list
     if 'TableUniverse' in df.columns:
         df = df.drop(['Year'], axis=1)
+        df = df.fillna("")
         df['TableUniverse'] = df['TableUniverse'].str.replace('"','', regex=True)
         df['TableUniverse'] = df['TableUniverse'].str.replace(',','-', regex=True)    
         df['TableTitle'] = df['TableTitle'].str.replace('"','', regex=True)
         df['TableTitle'] = df['TableTitle'].str.replace(',','-', regex=True)
+        return df
+
+    # Remove "ZCTA " from the geography names. Ex. "ZCTA 90210" --> "90210"
+    if 'NAME' in df.columns:
+        df['NAME'] = df['NAME'].str.replace('ZCTA5 ', '', regex=False)
+
+    # Estimate and margin of error columns become nullable numbers, with the Census sentinels as nulls.
+    # Tables parsed by stream_frames are already typed; text columns are converted as one block.
+    numeric = [col for col in df.columns if ESTIMATE_COLUMN.match(col)]
+    if numeric:
+        data, missing = numeric_block(df[numeric])
+        missing |= np.isin(data, CENSUS_SENTINELS)
+        data[missing] = 0
+        whole = (data % 1 == 0).all(axis=0)
+        columns = {}
+        for j, col in enumerate(numeric):
+            if whole[j]:
+                columns[col] = pd.arrays.IntegerArray(data[:, j].astype(np.int64), missing[:, j].copy())
+            else:
+                columns[col] = pd.arrays.FloatingArray(data[:, j].copy(), missing[:, j].copy())
+        df = pd.DataFrame({col: columns.get(col, df[col]) for col in df.columns}, index=df.index)
 
     return df
 
 
-def acs_ETL(df, tablename, filepath, year, table, geo, uid, pwd, ipaddress):
+# Staging formats
+# A table is written to the shared directory in one of these formats before it is loaded, in one or
+# more parts (one per --chunk-rows chunk):
+#  csv      comma separated text, loaded with BULK INSERT FORMAT = 'CSV'
+#  native   SQL Server's own binary layout, loaded with BULK INSERT and a format file without
+#           formatting numbers as text and parsing them back
+#  parquet  a dataset partitioned as year=/geo=/table=, loaded with batched INSERTs, or kept as the
+#           output of the run on its own with --sink files
+# Each format can also read its rows back as dataframes, for the tables that are too wide to bulk insert.
+
+class CsvStaging:
+    extension = '.txt'
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = 0
+
+    def write(self, df):
+        df.to_csv(self.path, encoding='utf-8', index=False, sep=',', mode='w' if self.parts == 0 else 'a', header=self.parts == 0)
+        self.parts += 1
+
+    def frames(self, chunksize):
+        return pd.read_csv(self.path, dtype=str, keep_default_na=False, na_values=[''], chunksize=chunksize)
+
+    def bulk_insert(self, target):
+        return "BULK INSERT " + target + " FROM '" + self.path + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class NativeStaging:
+    # Rows in bcp native format with a non-XML format file next to them describing the fields: numbers
+    # as SQLFLT8, a one byte length prefix and the little-endian double, and text as SQLCHAR, a two byte
+    # length prefix and the characters. A NULL is a prefix of all ones with no value. There is no header
+    # row. SQL Server converts each field to the type of its column as it loads, so the file does not
+    # depend on the types the table is created with. Whole numbers are stored as doubles too, since a
+    # table's parts are typed one at a time and a column that is whole in the first part may not be in
+    # a later one; doubles hold every whole number below 2**53 exactly.
+    extension = '.dat'
+
+    # Host field type -> (numpy type of the value, length prefix bytes)
+    FIELDS = {'SQLFLT8': ('<f8', 1), 'SQLCHAR': (None, 2)}
+
+    # Text is stored in the database's default code page
+    ENCODING = 'cp1252'
+
+    def __init__(self, path):
+        self.path = path
+        self.formatfile = os.path.splitext(path)[0] + '.fmt'
+        self.parts = 0
+        self.columns = None
+        self.types = None
+
+    @staticmethod
+    def field_type(dtype):
+        if pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+            return 'SQLFLT8'
+        return 'SQLCHAR'
+
+    def write(self, df):
+        # The first part fixes the field types of the file; later parts are written with the same types
+        if self.types is None:
+            self.columns = list(df.columns)
+            self.types = [self.field_type(dtype) for dtype in df.dtypes]
+            with open(self.formatfile, 'w') as f:
+                f.write(f'14.0\n{len(self.columns)}\n')
+                for j, (col, kind) in enumerate(zip(self.columns, self.types), 1):
+                    length = 8000 if kind == 'SQLCHAR' else 8
+                    f.write(f'{j}\t{kind}\t{self.FIELDS[kind][1]}\t{length}\t""\t{j}\t{col}\t""\n')
+        with open(self.path, 'wb' if self.parts == 0 else 'ab') as f:
+            f.write(self._encode(df))
+        self.parts += 1
+
+    def _encode(self, df):
+        # Each column is encoded as one byte string of its fields, then the fields are interleaved into rows
+        # by their offsets, so no python code runs per cell except encoding the text values
+        n = len(df)
+        blobs, lengths = [], np.zeros((n, len(self.columns)), dtype=np.int64)
+        for j, (col, kind) in enumerate(zip(self.columns, self.types)):
+            fmt, prefix = self.FIELDS[kind]
+            values = df[col]
+            null = values.isna().to_numpy(dtype=bool)
+            if fmt is not None:
+                size = np.dtype(fmt).itemsize
+                if not (pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype)) and not null.all():
+                    raise ValueError(f'{col} has text values after a part with numbers only')
+                data = values.to_numpy(dtype=np.float64, na_value=0)
+                fields = np.zeros(n, dtype=[('prefix', 'u1'), ('value', fmt)])
+                fields['prefix'] = np.where(null, 0xFF, size)
+                fields['value'] = data
+                keep = np.ones((n, 1 + size), dtype=bool)
+                keep[null, 1:] = False
+                blobs.append(fields.view(np.uint8).reshape(n, 1 + size)[keep])
+                lengths[:, j] = np.where(null, 1, 1 + size)
+            else:
+                text = [value.encode(self.ENCODING, errors='replace') for value in values[~null].astype(str)]
+                sizes = np.zeros(n, dtype=np.int64)
+                sizes[~null] = [len(value) for value in text]
+                prefixes = np.where(null, -1, sizes).astype(f'<i{prefix}').view(np.uint8).reshape(n, prefix)
+                blob = np.empty(int(sizes.sum()) + prefix * n, dtype=np.uint8)
+                starts = np.arange(n) * prefix + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+                blob[(starts[:, None] + np.arange(prefix)).ravel()] = prefixes.ravel()
+                scatter(blob, starts + prefix, sizes, np.frombuffer(b''.join(text), dtype=np.uint8))
+                blobs.append(blob)
+                lengths[:, j] = sizes + prefix
+
+        rows = np.empty(int(lengths.sum()), dtype=np.uint8)
+        offsets = np.cumsum(lengths.ravel()).reshape(lengths.shape) - lengths
+        for j, blob in enumerate(blobs):
+            scatter(rows, offsets[:, j], lengths[:, j], blob)
+        return rows.tobytes()
+
+    def frames(self, chunksize):
+        # Decode the file back into dataframes of at most chunksize rows
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        fields = [(struct.Struct('<' + np.dtype(fmt).char).unpack_from if fmt else None, prefix) for fmt, prefix in (self.FIELDS[kind] for kind in self.types)]
+        pos, rows = 0, []
+        while pos < len(data):
+            row = []
+            for unpack, prefix in fields:
+                size = int.from_bytes(data[pos:pos + prefix], 'little')
+                pos += prefix
+                if size == (1 << 8 * prefix) - 1:
+                    row.append(None)
+                elif unpack is not None:
+                    row.append(unpack(data, pos)[0])
+                    pos += size
+                else:
+                    row.append(data[pos:pos + size].decode(self.ENCODING))
+                    pos += size
+            rows.append(row)
+            if len(rows) == chunksize:
+                yield pd.DataFrame(rows, columns=self.columns)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows, columns=self.columns)
+
+    def bulk_insert(self, target):
+        return "BULK INSERT " + target + " FROM '" + self.path + "' WITH (TABLOCK, FORMATFILE = '" + self.formatfile + "');"
+
+    def remove(self):
+        os.remove(self.path)
+        os.remove(self.formatfile)
+
+
+class ParquetStaging:
+    # A directory of part-NNNNN.parquet files, one per part. SQL Server cannot bulk insert Parquet, so
+    # tables are loaded from it with insert_rows. Every file of the dataset has the same schema: a column
+    # is typed by the widest type any part has given it so far, and when a later part widens a column,
+    # ex. fractional values in a column that was whole in the earlier parts, the earlier files are
+    # rewritten with the wider type. Parts are never cast to a narrower type.
+    extension = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = 0
+        self.schema = None
+
+    @staticmethod
+    def widen(old, new):
+        # The type a column needs to hold values of both types
+        if old == new or pyarrow.types.is_null(new):
+            return old
+        if pyarrow.types.is_null(old):
+            return new
+        if all(pyarrow.types.is_string(t) or pyarrow.types.is_large_string(t) for t in (old, new)):
+            return pyarrow.large_string()
+        if (pyarrow.types.is_integer(old) or pyarrow.types.is_floating(old)) and (pyarrow.types.is_integer(new) or pyarrow.types.is_floating(new)):
+            return pyarrow.float64()
+        raise ValueError(f'cannot stage {new} values in a column of {old} values')
+
+    def _file(self, part):
+        return os.path.join(self.path, f'part-{part:05d}.parquet')
+
+    def write(self, df):
+        if pyarrow is None:
+            raise RuntimeError('The parquet staging format needs pyarrow: pip3 install pyarrow')
+        table = pyarrow.Table.from_pandas(df, preserve_index=False).replace_schema_metadata(None)
+        if self.parts == 0:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            fields = table.schema
+        else:
+            fields = [field.with_type(self.widen(field.type, table.schema.field(field.name).type)) for field in self.schema]
+        # Columns that only held nulls so far are kept as text
+        schema = pyarrow.schema([field.with_type(pyarrow.large_string()) if pyarrow.types.is_null(field.type) else field for field in fields])
+        if self.schema is not None and schema != self.schema:
+            for part in range(self.parts):
+                pyarrow.parquet.write_table(pyarrow.parquet.read_table(self._file(part)).cast(schema), self._file(part))
+        self.schema = schema
+        pyarrow.parquet.write_table(table.cast(self.schema), self._file(self.parts))
+        self.parts += 1
+
+    def frames(self, chunksize):
+        for name in sorted(os.listdir(self.path)):
+            df = pd.read_parquet(os.path.join(self.path, name), engine='pyarrow', dtype_backend='numpy_nullable')
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
+
+    def bulk_insert(self, target):
+        return None
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+STAGING_FORMATS = {'csv': CsvStaging, 'native': NativeStaging, 'parquet': ParquetStaging}
+
+def scatter(out, starts, lengths, blob):
+    # Copy blob, the concatenation of n byte strings of the given lengths, to out with the i-th string starting at starts[i]
+    lengths = np.asarray(lengths)
+    first = np.cumsum(lengths) - lengths
+    out[np.repeat(starts - first, lengths) + np.arange(blob.size)] = blob
+
+# Where tables are staged and in which format, and whether they are loaded into SQL Server ('sqlserver')
+# or the staged files are the output ('files'), and whether tables keep their wide layout or are unpivoted
+# into the long fact table ('long'). Call configure_staging before the first table is written.
+_staging_settings = {'format': 'csv', 'directory': '/HostData/', 'sink': 'sqlserver', 'layout': 'wide'}
+
+def configure_staging(format='csv', directory='/HostData/', sink='sqlserver', layout='wide'):
+    if format not in STAGING_FORMATS:
+        raise ValueError(f'Unknown staging format {format}')
+    if format == 'parquet' and pyarrow is None:
+        raise RuntimeError('The parquet staging format needs pyarrow: pip3 install pyarrow')
+    _staging_settings.update(format=format, directory=directory, sink=sink, layout=layout)
+
+def staging_file(year, geo, table, dataset=None):
+    # The staged copy of one table. Parquet tables are partitions of one dataset, the others are flat files.
+    directory, format = _staging_settings['directory'], _staging_settings['format']
+    dataset = dataset or ('ACS_5Y_Long' if long_layout() else 'ACS_5Y_Estimates')
+    if format == 'parquet':
+        path = os.path.join(directory, dataset, f'year={year}', f'geo={geo}', f'table={table}')
+    else:
+        path = os.path.join(directory, f'{dataset}_{year}_{geo}_{table}' + STAGING_FORMATS[format].extension)
+    return STAGING_FORMATS[format](path)
+
+def long_layout():
+    # True when tables are unpivoted into [dbo].[Estimates] instead of kept as wide tables
+    return _staging_settings['layout'] == 'long'
+
+def files_only():
+    # True when the run writes files and never connects to SQL Server
+    return _staging_settings['sink'] == 'files'
+
+
+class StagedTable:
+    # A table being parsed, cleaned and written to its staging file one payload at a time, with its
+    # row and byte counts, the profile of its columns and the time of each step. With --chunk-rows,
+    # only one chunk of the table is held in memory at a time. The first chunk is kept to build the
+    # table from, and the rest of the rows are read back from the file when needed.
+
+    def __init__(self, year, geo, table):
+        self.year, self.geo, self.table = year, geo, table
+        self.staged = staging_file(year, geo, table)
+        self.df, self.rows, self.bytes = None, 0, 0
+        self.profile = TableProfile()
+        self.clock = StageClock()
+
+    def add(self, payload):
+        clock = self.clock
+        parts = stream_frames(iter_chunks(payload), _pipeline_settings['chunk_rows'])
+        for part in clock.iterate('parse', parts):
+            with clock('clean'):
+                part = clean(part)
+            if long_layout():
+                with clock('unpivot'):
+                    part = unpivot(part, self.year, self.geo, self.table)
+            else:
+                with clock('column_stats'):
+                    self.profile.update(part)
+            with clock('stage_write'):
+                self.staged.write(part)
+            self.rows += len(part)
+            if self.df is None:
+                self.df = part
+        self.bytes += len(payload)
+
+    def record(self):
+        # One metric per step, with the payload bytes on the parse step
+        self.clock.fields['parse'] = {'bytes': self.bytes}
+        self.clock.record(self.year, self.geo, self.table, rows=self.rows)
+
+    def discard(self):
+        # Delete whatever was staged
+        if self.staged.parts:
+            self.staged.remove()
+
+
+# Table schemas
+# Column types are chosen from the values a table actually holds and the predicate types of its
+# variables in the variable catalog: INT or BIGINT for whole numbers, FLOAT for fractional ones and
+# float variables, CHAR(n) for fixed width codes such as GEO_ID and the state and county FIPS codes,
+# VARCHAR(n) sized to the longest value for other text, and NOT NULL for columns without nulls.
+# Tables with more than 1024 columns get sparse variable columns and a column set.
+
+MAX_COLUMNS = 1024
+MAX_VARCHAR = 8000
+
+# Column types of column_types that hold numbers
+NUMERIC_TYPES = ('INT', 'BIGINT', 'FLOAT')
+
+# Estimate, margin of error and annotation columns, ex. B01001_001E, B01001_001MA
+VARIABLE_COLUMN = re.compile(r'^[A-Z0-9]+_\d+[A-Z]+$')
+
+class TableProfile:
+    # Nulls, numeric ranges and text lengths of the columns of a table, accumulated over its parts
+
+    def __init__(self):
+        self.columns = {}
+
+    def update(self, df):
+        for col in df.columns:
+            values = df[col]
+            stats = self.columns.setdefault(col, {'nulls': False, 'numeric': None, 'fractional': False,
+                                                  'min': None, 'max': None, 'shortest': None, 'longest': 0})
+            present = values.dropna()
+            stats['nulls'] = stats['nulls'] or len(present) < len(values)
+            if len(present) == 0:
+                continue
+            if pd.api.types.is_numeric_dtype(values.dtype):
+                stats['numeric'] = stats['numeric'] is not False
+                low, high = present.min(), present.max()
+                stats['min'] = low if stats['min'] is None else min(stats['min'], low)
+                stats['max'] = high if stats['max'] is None else max(stats['max'], high)
+                stats['fractional'] = stats['fractional'] or bool((present % 1 != 0).any())
+            else:
+                # Empty text is loaded as NULL
+                lengths = present.astype(str).str.len()
+                if (lengths == 0).any():
+                    stats['nulls'] = True
+                    lengths = lengths[lengths > 0]
+                    if len(lengths) == 0:
+                        continue
+                stats['numeric'] = False
+                stats['shortest'] = int(lengths.min()) if stats['shortest'] is None else min(stats['shortest'], int(lengths.min()))
+                stats['longest'] = max(stats['longest'], int(lengths.max()))
+
+def column_types(profile, predicates=None):
+    # [(column, type, nullable)] for a profiled table. predicates maps variables to the PredicateType
+    # of the variable catalog; a table without them is typed from its values alone.
+    predicates = predicates or {}
+    schema = []
+    for col, stats in profile.columns.items():
+        predicate = predicates.get(col)
+        if stats['numeric'] is None:
+            # Only nulls were seen
+            numeric = ESTIMATE_COLUMN.match(col) is not None or predicate in ('INTEGER', 'FLOAT')
+        else:
+            numeric = stats['numeric']
+
+        if numeric and (stats['fractional'] or predicate == 'FLOAT'):
+            kind = 'FLOAT'
+        elif numeric:
+            low, high = stats['min'] or 0, stats['max'] or 0
+            kind = 'INT' if -2**31 <= low and high < 2**31 else 'BIGINT'
+        elif stats['longest'] > MAX_VARCHAR:
+            kind = 'VARCHAR(MAX)'
+        elif stats['shortest'] is not None and stats['shortest'] == stats['longest']:
+            kind = f'CHAR({stats["longest"]})'
+        else:
+            kind = f'VARCHAR({max(stats["longest"], 1)})'
+        schema.append((col, kind, stats['nulls']))
+    return schema
+
+def variable_types(year, table):
+    # {column: PredicateType} for the variables of a table, or {} if the variable catalog is unavailable
+    try:
+        cols = variable_catalog(year)
+    except (requests.RequestException, CacheMiss, ValueError, KeyError) as e:
+        logging.getLogger('api_logger').warning(f'No variable types for {year} {table}: {e}')
+        return {}
+    cols = cols[cols['TableName'] == table]
+    return dict(zip(cols['ColumnID'], cols['PredicateType']))
+
+def create_statement(target, schema, partition=None):
+    # CREATE TABLE for a schema from column_types. Past 1024 columns, the variables become sparse
+    # columns, which are always nullable, gathered in an XML column set. With a partition, ex.
+    # STATE_PARTITION, the table is created on that partition scheme.
+    wide = len(schema) > MAX_COLUMNS
+    columns = []
+    for col, kind, nullable in schema:
+        if wide and VARIABLE_COLUMN.match(col):
+            columns.append(f'[{col}] {kind} SPARSE NULL')
+        else:
+            columns.append(f'[{col}] {kind} {"NULL" if nullable else "NOT NULL"}')
+    if wide:
+        columns.append('[SpecialPurposeColumns] XML COLUMN_SET FOR ALL_SPARSE_COLUMNS')
+    placement = f' ON {partition}' if partition else ''
+    return f'CREATE TABLE {target} (\n\t' + ',\n\t'.join(columns) + f'\n){placement};'
+
+
+def acs_ETL(df, tablename, filepath, year, table, geo, uid, pwd, ipaddress, target=None, complete=True, staged=None, schema=None):
     # Set up logging
     logger = logging.getLogger('sql_logger')
 
-    # Modify the create statement with corrected datatypes
-    create = pd.io.sql.get_schema(df, f'[AmericanCommunitySurvey].[{year}_{geo}].[{table}]')
-    create = create.replace('"','',2)
-    create = create.replace("TEXT", "|")
-    create = create.replace("|", "VARCHAR(MAX)",1)
+    # The staged table to load from, in any of the staging formats. A bare filepath is a csv file.
+    if staged is None:
+        staged = CsvStaging(filepath)
 
-    create = create.split(",")
+    # The table is created under its own name, unless the caller wants to load it somewhere else first.
+    # Metrics are recorded under its own name either way.
+    name = table
+    table = target or table
+    target = f'[AmericanCommunitySurvey].[{year}_{geo}].[{table}]'
 
-    for i in range(1, len(create)-1):
-        if create[i][-4] == "E" or create[i][-4] == "M":
-            create[i] = create[i].replace("|", "INTEGER")
-        else:
-            create[i] = create[i].replace("|", "VARCHAR(MAX)")      
+    # Column types come from the profile of the whole table when the caller has one, otherwise from df
+    if schema is None:
+        profile = TableProfile()
+        profile.update(df)
+        schema = column_types(profile)
 
-    create = ','.join(create)
-    create = create.replace("|", "VARCHAR(MAX)")
+    # Block groups are partitioned by their state FIPS code
+    partitioned = geo == "BLOCKGROUP" and ('state', 'CHAR(2)') in [(col, kind) for col, kind, _ in schema]
+    create = create_statement(target, schema, partition=STATE_PARTITION if partitioned else None)
 
     # Execute table creation and bulk insert
     try:
-        sql_server(create, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
-        
-        bulk_insert = "BULK INSERT " + f'[AmericanCommunitySurvey].[{year}_{geo}].[{table}]' + " FROM '" + filepath + "' WITH (TABLOCK, FORMAT = 'CSV', FIRSTROW=2, FIELDTERMINATOR = ',',ROWTERMINATOR = '\n');"
-                                       
-        sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
-
-    except Exception as e:
-        # Some tables have >1024 columns. Here we are catching those and modifying their CREATE statement so as to store them as wide tables with sparse columns.
-        if "exceeds the maximum of 1024 columns" in str(e):
-            # Cast all Varchar columns as sparse varchars
-            create = create.replace("VARCHAR(MAX)", "VARCHAR(MAX) SPARSE NULL")
-            
-            # Cast all int columns as sparse ints
-            create = create.replace("INTEGER", "INTEGER SPARSE NULL")
-            
-            # SpecialPurposeColumns wide table definition
-            create = create[:-2] + ',\n "SpecialPurposeColumns" XML COLUMN_SET FOR ALL_SPARSE_COLUMNS);'
-            
-            # Create the table with the updated Create query
+        with timed('ddl', year, geo, name, columns=len(schema)):
             sql_server(create, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
 
-            # To fill the wide table with the data, rather than INSERTING all the null data, 
-            # we delete the columns with null data, and only INSERT data that is not null.
-            # This way, our INSERT statement isn't 1000+ columns long, when only 3 columns actually contain data.
-            df.replace('', np.nan, inplace=True)
-            df = df.dropna(axis='columns', how='all')
-            cols = str(df.columns.to_list()).replace("[","").replace("]","").replace("'","")
+        bulk_insert = staged.bulk_insert(target)
+
+        if len(schema) <= MAX_COLUMNS and bulk_insert is not None:
+            with timed('bulk_insert', year, geo, name, format=_staging_settings['format']):
+                sql_server(bulk_insert, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
 
-            for row in df.to_numpy().tolist():
-                if "'" in row[0]:
-                    row[0] = row[0].replace("'","''")
-                values = str(row).replace("[","").replace("]","").replace('"',"'")
-                insert ="INSERT " + f'[AmericanCommunitySurvey].[{year}_{geo}].[{table}] ' +  "(" + cols + ")" + "VALUES (" + values + ");"  
-                sql_server(insert, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+        elif len(schema) <= MAX_COLUMNS:
+            # Formats SQL Server cannot read are sent in batches of rows
+            with timed('insert', year, geo, name, format=_staging_settings['format']):
+                parts = [df] if complete else staged.frames(_load_settings['batch_size'])
+                for part in parts:
+                    insert_rows(part, target, ipaddress, uid, pwd)
 
         else:
-            traceback.print_exc()
-            logger.warning(e)
+            # Some tables have >1024 columns, and were created as wide tables with sparse columns.
+            # df may only be the first chunk of the table; the staged file always has every row
+            with timed('insert', year, geo, name, format=_staging_settings['format'], sparse=True):
+                if complete:
+                    parts = [df]
+                else:
+                    parts = staged.frames(_load_settings['batch_size'])
+                kinds = {col: kind for col, kind, _ in schema}
+
+                for df in parts:
+                    # To fill the wide table with the data, rather than INSERTING all the null data, 
+                    # we delete the columns with null data, and only INSERT data that is not null.
+                    # This way, our INSERT statement isn't 1000+ columns long, when only 3 columns actually contain data.
+                    df = df.replace('', np.nan)
+                    df = df.dropna(axis='columns', how='all')
+
+                    # The estimate and margin of error columns the schema made numeric are sent as numbers.
+                    # Geography columns such as NAME keep their text, ex. the leading zero of a ZCTA.
+                    for col in df.columns:
+                        if ESTIMATE_COLUMN.match(col) and kinds.get(col) in NUMERIC_TYPES:
+                            values = pd.to_numeric(df[col], errors='coerce')
+                            df[col] = values.astype("Int64") if kinds[col] != 'FLOAT' else values.astype("Float64")
+
+                    insert_rows(df, target, ipaddress, uid, pwd)
+
+    except Exception as e:
+        # Log it here, and let the caller know the table was not loaded
+        logger.warning(f'{year}_{geo}.{table}: {e}')
+        raise
+
+
+# Long layout
+# With --layout long, every table is unpivoted into one row per geography and variable, and all tables,
+# years and geographies go into a single fact table, [dbo].[Estimates]:
+#   Year, GeoLevel, GeoID, TableName, Variable, Estimate, MOE, EstimateAnnotation, MOEAnnotation
+# GeoLevel is the geography of the run (ZCTA, STATE, COUNTY, BLOCKGROUP) and Variable the column
+# name without its E/M suffix, ex. B01001_001. Rows without an estimate, a margin of error or an
+# annotation are left out. The table is partitioned by year and stored as a clustered columnstore;
+# since each (year, geography, table) is loaded by one bulk insert, its rows are compressed into row
+# groups of their own, which queries on GeoLevel, TableName or Variable skip without reading. Variable
+# labels become the [dbo].[VariableLabels] dimension, one row per year and variable, and the table
+# list is kept once in [dbo].[TableLegend]. There are no {year}_{geo} schemas and no width limits.
+
+FACT_TABLE = '[AmericanCommunitySurvey].[dbo].[Estimates]'
+LONG_COLUMNS = ['Year', 'GeoLevel', 'GeoID', 'TableName', 'Variable', 'Estimate', 'MOE', 'EstimateAnnotation', 'MOEAnnotation']
+
+def create_long_tables(ipaddress, uid, pwd, first_year=2009, last_year=2040):
+    # The fact and dimension tables, with one partition per year, if they do not exist yet
+    boundaries = ', '.join(str(year) for year in range(first_year + 1, last_year + 1))
+    statements = [
+        f"IF NOT EXISTS (SELECT * FROM sys.partition_functions WHERE name = 'pf_EstimatesYear') CREATE PARTITION FUNCTION [pf_EstimatesYear] (SMALLINT) AS RANGE RIGHT FOR VALUES ({boundaries});",
+        "IF NOT EXISTS (SELECT * FROM sys.partition_schemes WHERE name = 'ps_EstimatesYear') CREATE PARTITION SCHEME [ps_EstimatesYear] AS PARTITION [pf_EstimatesYear] ALL TO ([PRIMARY]);",
+        '''IF OBJECT_ID('[dbo].[Estimates]') IS NULL
+           BEGIN
+               CREATE TABLE [dbo].[Estimates] (
+                   [Year] SMALLINT NOT NULL, [GeoLevel] VARCHAR(16) NOT NULL, [GeoID] VARCHAR(64) NOT NULL,
+                   [TableName] VARCHAR(16) NOT NULL, [Variable] VARCHAR(24) NOT NULL,
+                   [Estimate] FLOAT NULL, [MOE] FLOAT NULL,
+                   [EstimateAnnotation] VARCHAR(16) NULL, [MOEAnnotation] VARCHAR(16) NULL
+               ) ON [ps_EstimatesYear] ([Year]);
+               CREATE CLUSTERED COLUMNSTORE INDEX [CCI_Estimates] ON [dbo].[Estimates] ON [ps_EstimatesYear] ([Year]);
+           END''',
+        '''IF OBJECT_ID('[dbo].[VariableLabels]') IS NULL
+               CREATE TABLE [dbo].[VariableLabels] (
+                   [Year] SMALLINT NOT NULL, [TableName] VARCHAR(16) NOT NULL, [Variable] VARCHAR(24) NOT NULL,
+                   [Label] VARCHAR(MAX), [Concept] VARCHAR(MAX), [PredicateType] VARCHAR(16),
+                   PRIMARY KEY ([Year], [Variable]));''',
+        "IF OBJECT_ID('[dbo].[TableLegend]') IS NULL CREATE TABLE [dbo].[TableLegend] (TableName VARCHAR(MAX), TableTitle VARCHAR(MAX), TableUniverse VARCHAR(MAX));",
+    ]
+    for statement in statements:
+        sql_server(statement, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+def unpivot(df, year, geo, table):
+    # The long rows of a cleaned table. The estimate, margin of error and annotation columns of all
+    # variables are stacked as (geographies x variables) blocks, and flattened row by row.
+    variables = [col[:-1] for col in df.columns if ESTIMATE_COLUMN.match(col) and col.endswith('E')]
+    n, k = len(df), len(variables)
+
+    def numbers(suffix):
+        cols = [v + suffix for v in variables]
+        present = [j for j, col in enumerate(cols) if col in df.columns]
+        data = np.zeros((n, k))
+        missing = np.ones((n, k), dtype=bool)
+        if present:
+            data[:, present], missing[:, present] = numeric_block(df[[cols[j] for j in present]])
+        data[missing] = 0
+        return data.ravel(), missing.ravel()
+
+    def text(suffix):
+        block = np.full((n, k), None, dtype=object)
+        for j, v in enumerate(variables):
+            if v + suffix in df.columns:
+                block[:, j] = df[v + suffix].to_numpy(dtype=object)
+        block = block.ravel()
+        block[pd.isna(block) | (block == '')] = None
+        return block
+
+    estimate, no_estimate = numbers('E')
+    moe, no_moe = numbers('M')
+    estimate_note, moe_note = text('EA'), text('MA')
+    keep = ~(no_estimate & no_moe & pd.isna(estimate_note) & pd.isna(moe_note))
+
+    long = pd.DataFrame({
+        'Year': np.full(n * k, int(year), dtype=np.int64),
+        'GeoLevel': np.full(n * k, geo, dtype=object),
+        'GeoID': np.repeat(df['GEO_ID'].to_numpy(dtype=object), k),
+        'TableName': np.full(n * k, table, dtype=object),
+        'Variable': np.tile(np.array(variables, dtype=object), n),
+        'Estimate': pd.arrays.FloatingArray(estimate, no_estimate),
+        'MOE': pd.arrays.FloatingArray(moe, no_moe),
+        'EstimateAnnotation': estimate_note,
+        'MOEAnnotation': moe_note,
+    })
+    return long[keep].reset_index(drop=True)
+
+def long_rows(year, geo, table, ipaddress, uid, pwd):
+    # The number of fact rows of one table, year and geography
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        cursor.execute(f'SELECT COUNT_BIG(*) FROM {FACT_TABLE} WHERE [Year] = ? AND [GeoLevel] = ? AND [TableName] = ?', [year, geo, table])
+        return cursor.fetchone()[0]
+
+def load_long(df, staged, year, geo, table, complete, ipaddress, uid, pwd):
+    # Replace the fact rows of one table, year and geography with the staged rows. Bulk loads swap the
+    # rows in one transaction; formats SQL Server cannot read are deleted, then inserted in batches.
+    delete = f'DELETE FROM {FACT_TABLE} WHERE [Year] = {int(year)} AND [GeoLevel] = {sql_literal(geo)} AND [TableName] = {sql_literal(table)};'
+    bulk_insert = staged.bulk_insert(FACT_TABLE)
+    if bulk_insert is not None:
+        with timed('bulk_insert', year, geo, table, format=_staging_settings['format'], layout='long'):
+            sql_server(transaction(f'{delete} {bulk_insert}'), 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+    else:
+        with timed('insert', year, geo, table, format=_staging_settings['format'], layout='long'):
+            sql_server(delete, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+            for part in ([df] if complete else staged.frames(_load_settings['batch_size'])):
+                insert_rows(part, FACT_TABLE, ipaddress, uid, pwd)
+
+def long_labels(cols, year):
+    # VariableLabels dimension rows: the estimate of each variable, keyed by the variable name
+    cols = cols[cols['ColumnID'].str.endswith('E')]
+    return pd.DataFrame({'Year': int(year), 'TableName': cols['TableName'].to_numpy(), 'Variable': cols['ColumnID'].str[:-1].to_numpy(),
+                         'Label': cols['Label'].to_numpy(), 'Concept': cols['Concept'].to_numpy(), 'PredicateType': cols['PredicateType'].to_numpy()})
+
+
+# Load history
+# Every table load is recorded in [dbo].[LoadHistory] with a hash of the API payload it came from and its
+# row and column counts. In incremental mode a table is only reloaded if its payload hash changed, or the
+# row count in the database no longer matches the history (a partial or missing load). Reloads go into a
+# staging table that is swapped in, so the old version stays readable until the new one is complete.
+
+def create_load_history(ipaddress, uid, pwd):
+    create = '''IF OBJECT_ID('[dbo].[LoadHistory]') IS NULL
+                CREATE TABLE [dbo].[LoadHistory] (
+                    [Year] INT NOT NULL, [Geo] VARCHAR(64) NOT NULL, [TableName] VARCHAR(32) NOT NULL,
+                    [ContentHash] CHAR(64) NOT NULL, [RowCount] BIGINT NOT NULL, [ColumnCount] INT NOT NULL,
+                    [LoadedAt] DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                    PRIMARY KEY ([Year], [Geo], [TableName]));'''
+    sql_server(create, 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+def read_load_history(geo, ipaddress, uid, pwd):
+    # {(year, table): (hash, rows, columns)} for every table of a geography that has been loaded
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        cursor.execute("SELECT [Year], [TableName], [ContentHash], [RowCount], [ColumnCount] FROM [dbo].[LoadHistory] WHERE [Geo] = ?", (geo,))
+        return {(row[0], row[1]): (row[2], row[3], row[4]) for row in cursor.fetchall()}
+
+def table_rows(year, geo, table, ipaddress, uid, pwd):
+    # The number of rows currently in a table, or None if it does not exist
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        cursor.execute(f"IF OBJECT_ID('[{year}_{geo}].[{table}]') IS NOT NULL SELECT COUNT_BIG(*) FROM [{year}_{geo}].[{table}] ELSE SELECT NULL")
+        return cursor.fetchone()[0]
+
+def swap_table(year, geo, table, staging, ipaddress, uid, pwd):
+    # Replace a table with its freshly loaded staging copy in one transaction
+    swap = f'''IF OBJECT_ID('[{year}_{geo}].[{table}]') IS NOT NULL DROP TABLE [{year}_{geo}].[{table}];
+               EXEC sp_rename '[{year}_{geo}].[{staging}]', '{table}';'''
+    sql_server(transaction(swap), 'AmericanCommunitySurvey', ipaddress, uid, pwd)
+
+def record_load(year, geo, table, digest, rows, columns, ipaddress, uid, pwd):
+    merge = '''MERGE [dbo].[LoadHistory] AS h
+               USING (SELECT ? AS [Year], ? AS [Geo], ? AS [TableName]) AS s
+               ON h.[Year] = s.[Year] AND h.[Geo] = s.[Geo] AND h.[TableName] = s.[TableName]
+               WHEN MATCHED THEN UPDATE SET [ContentHash] = ?, [RowCount] = ?, [ColumnCount] = ?, [LoadedAt] = SYSUTCDATETIME()
+               WHEN NOT MATCHED THEN INSERT ([Year], [Geo], [TableName], [ContentHash], [RowCount], [ColumnCount]) VALUES (s.[Year], s.[Geo], s.[TableName], ?, ?, ?);'''
+    sql_server(merge, 'AmericanCommunitySurvey', ipaddress, uid, pwd, params=(year, geo, table, digest, rows, columns, digest, rows, columns))
+
+
+# Post-load optimization
+# Loaded tables are heaps. With --optimize, once a run has loaded its tables, every table of each
+# {year}_{geo} schema gets a clustered index on GEO_ID, so tables of a schema join without scanning
+# each other, and is compressed:
+#  rowstore     a clustered primary key on GEO_ID (a plain clustered index if GEO_ID is not unique)
+#               with page compression; block group tables are keyed on GEO_ID and their state partition
+#  columnstore  a clustered columnstore index, which compresses by column, plus a page compressed
+#               nonclustered index on GEO_ID for joins and lookups
+# Tables with sparse columns cannot be compressed or stored as columnstore; they only get the clustered
+# index. Statistics are updated afterwards. Tables are indexed in parallel over the connection pool,
+# each build limited to MAXDOP threads on the server. Tables that already have a clustered index are
+# skipped, so the stage can be rerun to cover tables loaded later.
+
+OPTIMIZE_MODES = ('rowstore', 'columnstore')
+
+def table_space(cursor, table):
+    # Reserved KB of a table and its indexes
+    cursor.execute("SELECT COALESCE(SUM(a.total_pages), 0) * 8 FROM sys.partitions p JOIN sys.allocation_units a ON a.container_id = p.partition_id WHERE p.object_id = OBJECT_ID(?)", [table])
+    return cursor.fetchone()[0]
+
+def optimize_table(year, geo, table, mode, maxdop, ipaddress, uid, pwd):
+    # Index and compress one table. Returns (seconds, KB before, KB after), or None if it was already indexed.
+    name = f'[{year}_{geo}].[{table}]'
+    start = time.perf_counter()
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        cursor.execute("""SELECT OBJECTPROPERTY(OBJECT_ID(?), 'TableHasClustIndex'),
+                                  (SELECT COUNT(*) FROM sys.columns WHERE object_id = OBJECT_ID(?) AND is_sparse = 1),
+                                  (SELECT COUNT(*) FROM sys.partitions WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1))""", [name, name, name])
+        clustered, sparse, partitions = cursor.fetchone()
+        if clustered:
+            return None
+        before = table_space(cursor, name)
+
+        options = f'MAXDOP = {maxdop}' if sparse else f'DATA_COMPRESSION = PAGE, MAXDOP = {maxdop}'
+        if mode == 'columnstore' and not sparse:
+            cursor.execute(f'CREATE CLUSTERED COLUMNSTORE INDEX [CCI_{table}] ON {name} WITH (MAXDOP = {maxdop});')
+            cursor.execute(f'CREATE NONCLUSTERED INDEX [IX_{table}_GEO_ID] ON {name} ([GEO_ID]) WITH ({options});')
+        else:
+            try:
+                # A unique index of a partitioned table has to include the partitioning column
+                key = '[GEO_ID], [state]' if partitions > 1 else '[GEO_ID]'
+                cursor.execute(f'ALTER TABLE {name} ADD CONSTRAINT [PK_{table}] PRIMARY KEY CLUSTERED ({key}) WITH ({options});')
+            except DB_ERRORS as e:
+                # GEO_ID is nullable or has duplicates
+                logging.getLogger('sql_logger').info(f'{name}: no primary key on GEO_ID, using a clustered index: {e}')
+                cursor.execute(f'CREATE CLUSTERED INDEX [CIX_{table}] ON {name} ([GEO_ID]) WITH ({options});')
+
+        cursor.execute(f'UPDATE STATISTICS {name};')
+        after = table_space(cursor, name)
+    return time.perf_counter() - start, before, after
+
+def optimize_schema(year, geo, mode, workers, maxdop, ipaddress, uid, pwd):
+    # Index and compress every loaded table of a {year}_{geo} schema, workers tables at a time
+    logger = logging.getLogger('sql_logger')
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        cursor.execute("""SELECT t.name FROM sys.tables t JOIN sys.schemas s ON s.schema_id = t.schema_id
+                          WHERE s.name = ? AND t.name NOT IN ('VariableLabels', 'TableLegend') AND t.name NOT LIKE '%[_][_]staging'
+                          AND COL_LENGTH(QUOTENAME(s.name) + '.' + QUOTENAME(t.name), 'GEO_ID') IS NOT NULL
+                          ORDER BY t.name""", [f'{year}_{geo}'])
+        tables = [row[0] for row in cursor.fetchall()]
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(optimize_table, year, geo, table, mode, maxdop, ipaddress, uid, pwd): table for table in tables}
+        for future in futures:
+            table = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f'{year}_{geo}.{table}: optimize failed: {e}')
+                continue
+            if result is None:
+                continue
+            seconds, before, after = result
+            results[table] = result
+            record_metric('optimize', year, geo, table, seconds, mode=mode, kb_before=before, kb_after=after)
+            report = f'{year} - {geo} - {table}: {mode} in {seconds:.1f}s, {before / 1024:.1f} MB -> {after / 1024:.1f} MB ({before - after:,} KB saved)'
+            print(report)
+            logger.info(report)
+
+    if results:
+        seconds = sum(r[0] for r in results.values())
+        before = sum(r[1] for r in results.values())
+        after = sum(r[2] for r in results.values())
+        print(f'{year} - {geo}: optimized {len(results)} tables in {seconds:.0f}s of index builds, {before / 1024:.0f} MB -> {after / 1024:.0f} MB')
+    return results
+
+
+# SQL Server accepts at most 2100 parameters per statement, and 1000 rows per VALUES list
+MAX_PARAMETERS = 2100
+MAX_VALUES_ROWS = 1000
+
+_load_settings = {'batch_size': 1000}
+
+def configure_loader(batch_size=1000):
+    _load_settings['batch_size'] = batch_size
+
+def sql_literal(value):
+    # Quote a python value as a T-SQL literal
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "N'" + str(value).replace("'", "''") + "'"
+
+def transaction(statements):
+    # A T-SQL batch running statements in one transaction that is rolled back if any of them fails, and
+    # the error raised again. Pooled connections are shared, so this does not change session settings
+    # such as XACT_ABORT, which would stay in effect for every later borrower of the connection.
+    return f'''BEGIN TRY
+               BEGIN TRANSACTION;
+               {statements}
+               COMMIT TRANSACTION;
+               END TRY
+               BEGIN CATCH
+               IF XACT_STATE() <> 0 ROLLBACK TRANSACTION;
+               THROW;
+               END CATCH;'''
+
+def insert_rows(df, target, ipaddress, uid, pwd, batch_size=None):
+    # Insert a dataframe into an existing table in batches over one pooled connection.
+    # Rows go in through a parameterized executemany (fast_executemany on pyodbc), unless the table is
+    # too wide to bind one row's parameters, in which case batches are sent as multi-row VALUES lists.
+    batch_size = batch_size or _load_settings['batch_size']
+    columns = ", ".join(f"[{col}]" for col in df.columns)
+    rows = df.astype(object).where(df.notna(), None).values.tolist()
+
+    with sql_cursor('AmericanCommunitySurvey', ipaddress, uid, pwd) as cursor:
+        if len(df.columns) < MAX_PARAMETERS:
+            try:
+                cursor.fast_executemany = True
+            except AttributeError:
+                pass
+            insert = f"INSERT INTO {target} ({columns}) VALUES ({', '.join('?' * len(df.columns))});"
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany(insert, rows[i:i + batch_size])
+        else:
+            step = max(1, min(batch_size, MAX_VALUES_ROWS, 100000 // len(df.columns)))
+            for i in range(0, len(rows), step):
+                values = ",\n".join("(" + ", ".join(sql_literal(value) for value in row) + ")" for row in rows[i:i + step])
+                cursor.execute(f"INSERT INTO {target} ({columns}) VALUES {values};")
 
 
 def year_split(years):
@@ -305,12 +1539,753 @@ def year_split(years):
 
     return(year1, year2)
 
-def sql_server(query, db, ipaddress, uid, pwd):
-    # Connect to SQL Server and execute a query
-    conn = pyodbc.connect(f"DRIVER=ODBC Driver 17 for SQL Server;SERVER={ipaddress};DATABASE={db};UID={uid};PWD={pwd}", autocommit=True)
-    cursor = conn.cursor()
-    cursor.execute(query)
-    conn.commit()
+# Census API client
+# One keep-alive session shared by a pool of worker threads. Requests are spaced out to stay under
+# the configured requests-per-second, and 429/5xx responses, timeouts and dropped connections are
+# retried with exponential backoff before giving up.
+
+CENSUS_API = 'https://api.census.gov/data'
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def strip_key(url):
+    # Remove the API key from a url, so it can be logged or used as a lookup key
+    return re.sub(r'([?&])key=[^&]*&?', r'\1', url).rstrip('?&')
+
+
+class CacheMiss(Exception):
+    # Raised in offline mode for a url that is not in the cache
+    pass
+
+
+class HttpCache:
+    # Content-addressed, gzip-compressed store of successful responses, keyed by the url without the API key.
+    # Data from past ACS vintages never changes, so api.census.gov/data/{year}/ responses for vintages more
+    # than a year old never expire; everything else (table lists, recent vintages) expires after `ttl` seconds.
+    # When the cache grows past `max_bytes`, the least recently used entries are evicted.
+    # In offline mode nothing is downloaded, and a url that is not cached raises CacheMiss.
+
+    def __init__(self, directory, max_bytes=5 * 1024**3, ttl=7 * 24 * 3600, offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.gz'):
+                self._sizes[entry.name[:-3]] = entry.stat().st_size
+        self._total = sum(self._sizes.values())
+
+    def _key(self, url):
+        return hashlib.sha256(strip_key(url).encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        path = os.path.join(self.directory, key)
+        return path + '.gz', path + '.json'
+
+    def _immutable(self, url):
+        vintage = re.search(r'api\.census\.gov/data/(\d{4})/', url)
+        return vintage is not None and int(vintage.group(1)) < datetime.date.today().year - 1
+
+    def get(self, url):
+        key = self._key(url)
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['expires'] is not None and meta['expires'] < time.time() and not self.offline:
+                return None
+            with gzip.open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError, KeyError):
+            if self.offline:
+                raise CacheMiss(strip_key(url))
+            return None
+
+        # Mark the entry as recently used
+        os.utime(body_path)
+
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = body
+        response.headers.update(meta['headers'])
+        response.encoding = meta['encoding']
+        response.url = url
+        return response
+
+    def put(self, url, response):
+        key = self._key(url)
+        body_path, meta_path = self._paths(key)
+        meta = {'url': strip_key(url),
+                'stored': time.time(),
+                'expires': None if self._immutable(url) else time.time() + self.ttl,
+                'encoding': response.encoding,
+                'headers': {k: v for k, v in response.headers.items() if k.lower() == 'content-type'}}
+
+        # Write to temporary files and rename, so concurrent readers never see half an entry
+        suffix = f'.{threading.get_ident()}.tmp'
+        with gzip.open(body_path + suffix, 'wb', compresslevel=6) as f:
+            f.write(response.content)
+        with open(meta_path + suffix, 'w') as f:
+            json.dump(meta, f)
+        os.replace(body_path + suffix, body_path)
+        os.replace(meta_path + suffix, meta_path)
+
+        with self._lock:
+            size = os.path.getsize(body_path)
+            self._total += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Remove least recently used entries until the cache is back under 90% of its cap
+        entries = []
+        for key in self._sizes:
+            try:
+                entries.append((os.path.getmtime(self._paths(key)[0]), key))
+            except OSError:
+                entries.append((0, key))
+        for _, key in sorted(entries):
+            if self._total <= self.max_bytes * 0.9:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total -= self._sizes.pop(key)
+
+
+class RateLimiter:
+    # Hands out evenly spaced start times to callers across threads, at most `rate` per second
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class CensusClient:
+
+    def __init__(self, workers=8, rate=10, retries=5, backoff=1.0, timeout=100, cache=None):
+        self.cache = cache
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _delay(self, attempt, retry_after=None):
+        # Honour the server's Retry-After if it sent one, otherwise back off exponentially with jitter
+        if retry_after is not None and str(retry_after).isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    def get(self, url, timeout=None):
+        # Serve from the local cache when possible, and cache every successful download
+        if self.cache is not None:
+            response = self.cache.get(url)
+            if response is None:
+                response = self._download(url, timeout)
+                if response.status_code == 200:
+                    self.cache.put(url, response)
+            return response
+        return self._download(url, timeout)
+
+    def _download(self, url, timeout=None):
+        logger = logging.getLogger('api_logger')
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                response = self.session.get(url, timeout=timeout or self.timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self._delay(attempt)
+                logger.warning(f'{type(e).__name__} {strip_key(url)}, retrying in {delay:.1f}s')
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                delay = self._delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f'{response.status_code} {strip_key(url)}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+    def map(self, fn, items):
+        # Call fn on each item from a thread pool, keeping at most `workers` calls in flight.
+        # Yields (item, result, error) tuples in completion order; exceptions are returned, not raised.
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(fn, item): item for item in islice(items, self.workers)}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = futures.pop(future)
+                    error = future.exception()
+                    yield item, (future.result() if error is None else None), error
+                    for following in islice(items, 1):
+                        futures[executor.submit(fn, following)] = following
+
+    def close(self):
+        self.session.close()
+
+# One client per run, created on first use. Call configure_client before the first request to change
+# the concurrency, rate limit or retry policy.
+_client = None
+_client_settings = {'workers': 8, 'rate': 10, 'retries': 5, 'cache': None}
+_client_lock = threading.Lock()
+
+def configure_client(workers=8, rate=10, retries=5, cache=None):
+    _client_settings.update(workers=workers, rate=rate, retries=retries, cache=cache)
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CensusClient(**_client_settings)
+        return _client
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+# Run metrics
+# Every stage of every table is timed and appended to a JSON-lines file, one object per measurement:
+#   {"run": "host:pid:start", "time": 1700000000.0, "stage": "fetch", "year": 2020, "geo": "ZCTA",
+#    "table": "B01001", "seconds": 1.92, "bytes": 5242880, "status": 200}
+# Stages are fetch (HTTP latency and payload bytes), parse, clean, column_stats or unpivot, stage_write,
+# load (with the row count) and checkpoint, and optimize after the run. Within them, fetch_state times
+# each block group slice, and ddl and bulk_insert (insert for batched INSERTs) the steps of a load. At the end of a run
+# summarize_metrics reports p50/p95 per stage, the slowest tables and rows per second. With
+# --profile-table, the transform and load stages of one table also run under cProfile and tracemalloc.
+
+class MetricsLog:
+    # Appends measurements to a JSON-lines file, from any thread
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.run = f'{socket.gethostname()}:{os.getpid()}:{int(self.started)}'
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1)
+
+    def record(self, stage, year=None, geo=None, table=None, seconds=None, **fields):
+        entry = {'run': self.run, 'time': round(time.time(), 3), 'stage': stage,
+                 'year': None if year is None else int(year), 'geo': geo, 'table': table}
+        if seconds is not None:
+            entry['seconds'] = round(seconds, 6)
+        entry.update(fields)
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class StageClock:
+    # Accumulates the time of stages that run once per chunk of a table, to record one total per stage
+
+    def __init__(self):
+        self.seconds = {}
+        self.fields = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+
+    def iterate(self, stage, iterable):
+        # Time the production of each item of an iterable, ex. parsing the next chunk of a payload
+        iterator, done = iter(iterable), object()
+        while True:
+            with self(stage):
+                item = next(iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def record(self, year, geo, table, **fields):
+        # One measurement per stage, each with the given fields and its own from self.fields
+        for stage, seconds in self.seconds.items():
+            record_metric(stage, year, geo, table, seconds, **fields, **self.fields.get(stage, {}))
+
+_metrics_settings = {'log': None, 'profile_table': None, 'profile_dir': '/HostData/'}
+_profile_lock = threading.Lock()
+
+def configure_metrics(path=None, profile_table=None, profile_dir='/HostData/'):
+    # Without a path, nothing is recorded
+    close_metrics()
+    _metrics_settings.update(log=MetricsLog(path) if path else None, profile_table=profile_table, profile_dir=profile_dir)
+
+def close_metrics():
+    if _metrics_settings['log'] is not None:
+        _metrics_settings['log'].close()
+        _metrics_settings['log'] = None
+
+def record_metric(stage, year=None, geo=None, table=None, seconds=None, **fields):
+    log = _metrics_settings['log']
+    if log is not None:
+        log.record(stage, year, geo, table, seconds, **fields)
+
+@contextmanager
+def timed(stage, year=None, geo=None, table=None, **fields):
+    # Record how long the block took. The block can add fields, ex. rows or bytes, to the yielded dict;
+    # a block that raises is recorded with failed set.
+    fields = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException:
+        fields['failed'] = True
+        raise
+    finally:
+        record_metric(stage, year, geo, table, time.perf_counter() - start, **fields)
+
+@contextmanager
+def profiled(stage, year, geo, table):
+    # Run a stage of the --profile-table table under cProfile and tracemalloc. The profile is saved as
+    # profile_{year}_{geo}_{table}_{stage}.prof for pstats, its top functions are logged, and the peak
+    # traced memory and largest allocation sites are recorded as a 'profiling' measurement. cProfile
+    # only sees the calling thread, while tracemalloc traces every thread, so allocations of other
+    # tables in flight at the same time are included. One block is profiled at a time.
+    if table != _metrics_settings['profile_table'] or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        allocations = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        if not tracing:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+        path = os.path.join(_metrics_settings['profile_dir'], f'profile_{year}_{geo}_{table}_{stage}.prof')
+        profiler.dump_stats(path)
+        report = StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(25)
+        logging.getLogger('api_logger').info(f'Profile of {year} - {geo} - {table} {stage}, saved to {path}:\n{report.getvalue()}')
+        record_metric('profiling', year, geo, table, stage_profiled=stage, peak_bytes=peak, profile=path,
+                      allocations=[str(stat) for stat in allocations])
+
+# Stages timed within another stage, left out of the total time of a table
+NESTED_STAGES = ('fetch_state', 'ddl', 'bulk_insert', 'insert')
+
+def summarize_metrics(path, run=None, slowest=10):
+    # A text report of one run in a metrics file, the last one by default: time per stage with its
+    # p50/p95, throughput, and the tables that took longest
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        return f'No metrics in {path}'
+    run = run or entries[-1]['run']
+    metrics = pd.DataFrame([entry for entry in entries if entry['run'] == run])
+    for col in ('seconds', 'rows', 'bytes'):
+        if col not in metrics.columns:
+            metrics[col] = np.nan
+    metrics['year'] = metrics['year'].astype('Int64')
+
+    lines = [f'Run {run}']
+    wall = metrics.loc[metrics['stage'] == 'run', 'seconds']
+    loaded = metrics.loc[metrics['stage'] == 'load']
+    if len(wall):
+        rows = loaded['rows'].sum()
+        lines.append(f'{wall.iloc[-1]:.0f}s, {len(loaded)} tables and {rows:,.0f} rows loaded, {rows / max(wall.iloc[-1], 1e-9):,.0f} rows/s')
+
+    # Time per stage. Stages run concurrently, so their totals add up to more than the run took.
+    stages = metrics[metrics['seconds'].notna() & ~metrics['stage'].isin(['run', 'profiling'])]
+    by_stage = stages.groupby('stage', sort=False).agg(count=('seconds', 'size'), total_s=('seconds', 'sum'),
+                                                       p50_s=('seconds', 'median'), p95_s=('seconds', lambda s: s.quantile(0.95)),
+                                                       max_s=('seconds', 'max'), rows=('rows', 'sum'), MB=('bytes', 'sum'))
+    by_stage[['rows', 'MB']] = by_stage[['rows', 'MB']].replace(0, np.nan)
+    by_stage['MB'] = by_stage['MB'] / 1024**2
+    by_stage['rows_per_s'] = by_stage['rows'] / by_stage['total_s']
+    by_stage['MB_per_s'] = by_stage['MB'] / by_stage['total_s']
+    lines += ['', 'Stages', by_stage.round(3).to_string()]
+
+    # Tables by their time in every stage, with the time of each stage
+    tables = stages[stages['table'].notna()]
+    if len(tables):
+        per_table = tables.pivot_table(index=['year', 'geo', 'table'], columns='stage', values='seconds', aggfunc='sum', fill_value=0)
+        per_table = per_table[[stage for stage in by_stage.index if stage in per_table.columns]]
+        per_table.insert(0, 'total_s', per_table.drop(columns=list(NESTED_STAGES), errors='ignore').sum(axis=1))
+        per_table = per_table.sort_values('total_s', ascending=False).head(slowest)
+        lines += ['', f'Slowest {len(per_table)} tables', per_table.round(2).to_string()]
+    return '\n'.join(lines)
+
+
+# Staged pipeline
+# Each stage has its own worker threads, and bounded queues between the stages provide backpressure:
+# when loading falls behind, transform workers block, then fetch workers, so only a fixed number of
+# tables are ever held in memory. A failure is recorded against its item and the item is dropped.
+
+_DONE = object()
+
+class Pipeline:
+
+    def __init__(self, stages, buffer=4, on_error=None):
+        # stages is a list of (name, fn, workers); fn(key, value) returns the value passed to the next
+        # stage, or None to drop the item without an error. on_error(key, stage, error) is called for failures.
+        self.stages = stages
+        self.buffer = buffer
+        self.on_error = on_error
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def _work(self, name, fn, inbox, outbox, remaining, downstream):
+        logger = logging.getLogger('api_logger')
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            key, value = item
+            try:
+                value = fn(key, value)
+            except Exception as e:
+                traceback.print_exc()
+                logger.warning(f'{key} failed in {name}: {e}')
+                with self._lock:
+                    self.errors.append((key, name, e))
+                if self.on_error is not None:
+                    try:
+                        self.on_error(key, name, e)
+                    except Exception:
+                        traceback.print_exc()
+                continue
+            if value is not None and outbox is not None:
+                outbox.put((key, value))
+
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with self._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            for _ in range(downstream):
+                outbox.put(_DONE)
+
+    def run(self, items):
+        # Push (key, value) items through every stage, returning the list of (key, stage, error) failures
+        queues = [queue.Queue(maxsize=self.buffer) for _ in self.stages] + [None]
+        threads = []
+        for i, (name, fn, workers) in enumerate(self.stages):
+            downstream = self.stages[i + 1][2] if i + 1 < len(self.stages) else 0
+            remaining = [workers]
+            for _ in range(workers):
+                thread = threading.Thread(target=self._work, args=(name, fn, queues[i], queues[i + 1], remaining, downstream), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        return self.errors
+
+# Job manifest
+# A SQLite file listing every (year, geo, table) unit of a run with its status, attempts and timings.
+# Worker processes, on this host or on others sharing /HostData, claim units one at a time inside a
+# write transaction, so no unit is handed to two workers. A claim is a lease: workers renew the leases
+# of their running units in the background, and a unit whose lease ran out (its worker crashed) can be
+# claimed again. Failed units are retried until they reach max_attempts.
+# Note that SQLite's locking relies on the file system; use a local disk or a share with working locks.
+
+class JobManifest:
+
+    def __init__(self, path, lease=1800, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                                year INTEGER NOT NULL, geo TEXT NOT NULL, tbl TEXT NOT NULL,
+                                status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                                worker TEXT, lease_until REAL, started REAL, finished REAL, seconds REAL, error TEXT,
+                                PRIMARY KEY (year, geo, tbl))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS units_status ON units (geo, status)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def add(self, geo, units):
+        # Add (year, table) units for a geography. Units already in the manifest keep their status.
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR IGNORE INTO units (year, geo, tbl) VALUES (?, ?, ?)", [(year, geo, table) for year, table in units])
+            conn.execute("COMMIT")
+
+    def reset(self):
+        # Put every unit back to pending with no attempts, for when the tables they loaded were dropped
+        with self._connect() as conn:
+            conn.execute("""UPDATE units SET status = 'pending', attempts = 0, worker = NULL, lease_until = NULL,
+                            started = NULL, finished = NULL, seconds = NULL, error = NULL""")
+
+    def claim(self, worker, geo, year1, year2):
+        # Atomically take the next available unit of a geography, returning (year, table) or None
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""SELECT year, tbl FROM units
+                                  WHERE geo = ? AND year >= ? AND year < ?
+                                  AND (status = 'pending'
+                                       OR (status = 'running' AND lease_until < ?)
+                                       OR (status = 'failed' AND attempts < ?))
+                                  ORDER BY rowid LIMIT 1""", (geo, year1, year2, now, self.max_attempts)).fetchone()
+            if row is not None:
+                conn.execute("""UPDATE units SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?,
+                                started = ?, finished = NULL, seconds = NULL, error = NULL
+                                WHERE year = ? AND geo = ? AND tbl = ?""", (worker, now + self.lease, now, row[0], geo, row[1]))
+            conn.execute("COMMIT")
+        return None if row is None else (row[0], row[1])
+
+    def claims(self, worker, geo, year1, year2):
+        # Claim units one by one until the geography has nothing left to do
+        while True:
+            unit = self.claim(worker, geo, year1, year2)
+            if unit is None:
+                return
+            yield unit
+
+    def finish(self, year, geo, table, status, error=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("""UPDATE units SET status = ?, finished = ?, seconds = ? - started, error = ?, lease_until = NULL
+                            WHERE year = ? AND geo = ? AND tbl = ?""", (status, now, now, error, year, geo, table))
+
+    def renew(self, worker):
+        # Extend the leases of every unit this worker is running
+        with self._connect() as conn:
+            conn.execute("UPDATE units SET lease_until = ? WHERE worker = ? AND status = 'running'", (time.time() + self.lease, worker))
+
+    def keepalive(self, worker):
+        # Renew this worker's leases from a background thread until the returned event is set
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease / 3):
+                try:
+                    self.renew(worker)
+                except sqlite3.Error as e:
+                    logging.getLogger('api_logger').warning(f'Could not renew leases: {e}')
+
+        threading.Thread(target=renew, daemon=True).start()
+        return stop
+
+    def summary(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+
+
+_pipeline_settings = {'transform_workers': 2, 'load_workers': 2, 'buffer': 4, 'chunk_rows': None}
+
+def configure_pipeline(transform_workers=2, load_workers=2, buffer=4, chunk_rows=None):
+    _pipeline_settings.update(transform_workers=transform_workers, load_workers=load_workers, buffer=buffer, chunk_rows=chunk_rows)
+
+
+def pyodbc_backend(db, ipaddress, uid, pwd):
+    # Default backend: a SQL Server connection through the Microsoft ODBC driver
+    return pyodbc.connect(f"DRIVER=ODBC Driver 17 for SQL Server;SERVER={ipaddress};DATABASE={db};UID={uid};PWD={pwd}", autocommit=True)
+
+def sqlite_backend(directory):
+    # Local stand-in backend: every database name maps to a sqlite file in the given directory.
+    # Only useful for exercising the pool and the plumbing around it, the T-SQL itself will not run.
+    def connect(db, ipaddress, uid, pwd):
+        return sqlite3.connect(os.path.join(directory, f'{db}.sqlite'), isolation_level=None, check_same_thread=False)
+    return connect
+
+
+class ConnectionPool:
+    # A bounded set of long-lived connections per database. Callers borrow a connection, run their
+    # statements, and hand it back, instead of paying an ODBC handshake for every statement.
+    # Connections that have sat idle are health checked before reuse, and a connection that fails
+    # its health check (or dies underneath a statement) is thrown away and replaced.
+
+    def __init__(self, ipaddress, uid, pwd, backend=None, maxsize=4, healthcheck='SELECT 1', healthcheck_after=30):
+        self.ipaddress = ipaddress
+        self.uid = uid
+        self.pwd = pwd
+        self.backend = backend or pyodbc_backend
+        self.maxsize = maxsize
+        self.healthcheck = healthcheck
+        self.healthcheck_after = healthcheck_after
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _slot(self, db):
+        with self._lock:
+            if db not in self._slots:
+                self._slots[db] = threading.BoundedSemaphore(self.maxsize)
+                self._idle[db] = []
+            return self._slots[db]
+
+    def _healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.healthcheck)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self, db):
+        # Reuse the most recently returned connection if there is one, otherwise open a new one
+        while True:
+            with self._lock:
+                idle = self._idle[db].pop() if self._idle[db] else None
+            if idle is None:
+                return self.backend(db, self.ipaddress, self.uid, self.pwd)
+            conn, returned = idle
+            if time.monotonic() - returned < self.healthcheck_after or self._healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def _checkin(self, db, conn):
+        with self._lock:
+            if self._closed:
+                self._discard(conn)
+            else:
+                self._idle[db].append((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self, db):
+        # Borrow a connection for the duration of the with-block. Blocks while maxsize connections
+        # to this database are already checked out.
+        slot = self._slot(db)
+        slot.acquire()
+        conn = None
+        try:
+            conn = self._checkout(db)
+            yield conn
+        except Exception:
+            # Only keep the connection if the failure was the statement's fault, not the connection's
+            if conn is not None and not self._healthy(conn):
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(db, conn)
+            slot.release()
+
+    @contextmanager
+    def cursor(self, db):
+        # Borrow a connection and hand out a cursor on it, committing when the block succeeds
+        with self.connection(db) as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def execute(self, query, db, params=None, retries=1):
+        # Execute a single statement. If the connection turns out to be dead, reconnect and retry.
+        for attempt in range(retries + 1):
+            try:
+                with self.cursor(db) as cursor:
+                    if params is None:
+                        cursor.execute(query)
+                    else:
+                        cursor.execute(query, params)
+                return
+            except DB_ERRORS as e:
+                if attempt == retries or not is_disconnect(e):
+                    raise
+                logging.getLogger('sql_logger').warning(f'Reconnecting to {db} after: {e}')
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle = [conn for conns in self._idle.values() for conn, _ in conns]
+            for conns in self._idle.values():
+                conns.clear()
+        for conn in idle:
+            self._discard(conn)
+
+
+def is_disconnect(e):
+    # SQLSTATE classes 08 (connection exception) and HYT00/HYT01 (timeouts) mean the statement never
+    # reached the server, or the connection was lost, so it is safe to retry on a new connection.
+    state = str(e.args[0]) if getattr(e, 'args', None) else ''
+    return state.startswith('08') or state in ('HYT00', 'HYT01') or 'Communication link failure' in str(e)
+
+# One pool per server login, created on first use. Call configure_pool before the first statement
+# to change the backend or the number of connections kept per database.
+_pools = {}
+_pool_settings = {'backend': None, 'maxsize': 4}
+_pools_lock = threading.Lock()
+
+def configure_pool(backend=None, maxsize=4):
+    _pool_settings['backend'] = backend
+    _pool_settings['maxsize'] = maxsize
+
+def get_pool(ipaddress, uid, pwd):
+    with _pools_lock:
+        key = (ipaddress, uid)
+        if key not in _pools:
+            _pools[key] = ConnectionPool(ipaddress, uid, pwd, backend=_pool_settings['backend'], maxsize=_pool_settings['maxsize'])
+        return _pools[key]
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+def sql_server(query, db, ipaddress, uid, pwd, params=None):
+    # Execute a query on SQL Server using a pooled connection
+    get_pool(ipaddress, uid, pwd).execute(query, db, params)
+
+def sql_cursor(db, ipaddress, uid, pwd):
+    # Borrow a pooled cursor, for callers that need results or several statements on one connection
+    return get_pool(ipaddress, uid, pwd).cursor(db)
 
     
 if __name__ == "__main__":
@@ -321,9 +2296,9 @@ if __name__ == "__main__":
     parser.add_argument('-y', '--year', type= str, required=True, action="store", help='The year (format "YYYY"|]) or years (format "YYYY-YYYY") to download data for. This should be a str.')
     parser.add_argument('-s', '--start', type= str, required=False, action="store", default = 'B01001', help='To pull a single table, or start the pull from a specific table, define it here as a string, ex. "B01001".')
     parser.add_argument('-a', '--alone', required=False, action="store_false", help='This option allows for the selection of a single table to be downloaded.')
-    parser.add_argument('-u', '--uid', type= str, required=True, action="store", help='User ID for the DB server')
-    parser.add_argument('-p', '--pwd', type= str, required=True, action="store", help='Password for the DB server')
-    parser.add_argument('-i', '--ipaddress', type= str, required=True, action="store", help='The network address of the DB server')    
+    parser.add_argument('-u', '--uid', type= str, required=False, action="store", help='User ID for the DB server. Required unless --sink files.')
+    parser.add_argument('-p', '--pwd', type= str, required=False, action="store", help='Password for the DB server. Required unless --sink files.')
+    parser.add_argument('-i', '--ipaddress', type= str, required=False, action="store", help='The network address of the DB server. Required unless --sink files.')    
     parser.add_argument('-k', '--apikey', type= str, required=True, action="store", help='The API key to access the Census.gov API. Request a free API key here: https://api.census.gov/data/key_signup.html')    
     parser.add_argument('-z', '--zcta', required=False, action="store_false", help='This option allows for the selection of the ZCTA geographical rollup.')
     parser.add_argument('-st', '--state', required=False, action="store_false", help='This option allows for the selection of the State geographical rollup.')
@@ -331,6 +2306,35 @@ if __name__ == "__main__":
     parser.add_argument('-b', '--blockgroup', required=False, action="store_false", help='This option allows for the selection of the block group level geographical rollup.')    
     parser.add_argument('-r', '--restart', required=False, action="store_false", help='This option allows for adding data without deleting previously collected data. Useful for when a scrape fails and you want to pick up at a certain point.')
     parser.add_argument('-cl', '--cleanup', required=False, action="store_false", help='This option allows for the cleanup of the host directory, to save disk space.')
+    parser.add_argument('--refresh-catalog', required=False, action="store_true", help='Scrape the ACS table list again instead of using the saved /HostData/TableCatalog.pkl.')
+    parser.add_argument('--incremental', required=False, action="store_true", help='Keep the existing db and only reload tables whose API data changed, or that are missing or incomplete.')
+    parser.add_argument('--manifest', type= str, required=False, action="store", help='Path of a SQLite job manifest that tracks every (year, geography, table) of the run, ex. "/HostData/manifest.sqlite". Several processes given the same manifest share the work.')
+    parser.add_argument('--plan', required=False, action="store_true", help='With --manifest, set up the database and schemas and add this run to the manifest before working on it. Other processes join with --manifest alone.')
+    parser.add_argument('--lease', type= float, required=False, action="store", default = 1800, help='Seconds before a table claimed by a worker that stopped responding can be claimed by another worker.')
+    parser.add_argument('--max-attempts', type= int, required=False, action="store", default = 3, help='How many times a table that fails is tried before it is left as failed in the manifest.')
+    parser.add_argument('--workers', type= int, required=False, action="store", default = 8, help='The number of Census API requests to keep in flight at once.')
+    parser.add_argument('--rate', type= float, required=False, action="store", default = 10, help='The maximum number of Census API requests started per second.')
+    parser.add_argument('--retries', type= int, required=False, action="store", default = 5, help='How many times a Census API request is retried, with exponential backoff, after a timeout or a 429/5xx response.')
+    parser.add_argument('--transform-workers', type= int, required=False, action="store", default = 2, help='The number of threads cleaning downloaded tables and writing them to /HostData.')
+    parser.add_argument('--load-workers', type= int, required=False, action="store", default = 2, help='The number of threads bulk loading tables into SQL Server.')
+    parser.add_argument('--buffer', type= int, required=False, action="store", default = 4, help='The number of tables allowed to wait between pipeline stages, which caps memory use.')
+    parser.add_argument('--batch-size', type= int, required=False, action="store", default = 1000, help='The number of rows sent per batch when loading tables too wide for BULK INSERT.')
+    parser.add_argument('--cache-dir', type= str, required=False, action="store", default = '/HostData/http_cache', help='Directory for the local cache of Census API and table list responses.')
+    parser.add_argument('--cache-size', type= int, required=False, action="store", default = 5000, help='The maximum size of the response cache in MB. The least recently used responses are evicted first.')
+    parser.add_argument('--cache-ttl', type= float, required=False, action="store", default = 168, help='Hours before cached responses that can change (table lists, recent vintages) are downloaded again.')
+    parser.add_argument('--no-cache', required=False, action="store_true", help='Always download from the Census API, without reading or writing the response cache.')
+    parser.add_argument('--offline', required=False, action="store_true", help='Only use responses already in the cache, never the network.')
+    parser.add_argument('--chunk-rows', type= int, required=False, action="store", default = 0, help='Parse and write each table in chunks of this many rows, to bound memory use on very large tables. 0 processes each table in one piece.')
+    parser.add_argument('--staging', type= str, required=False, action="store", default = 'csv', choices=sorted(STAGING_FORMATS), help='The format tables are written in before loading: csv text, SQL Server native binary, or a parquet dataset partitioned by year, geo and table.')
+    parser.add_argument('--staging-dir', type= str, required=False, action="store", default = '/HostData/', help='Directory tables are staged in. When loading into SQL Server, the server must be able to read it at the same path.')
+    parser.add_argument('--sink', type= str, required=False, action="store", default = 'sqlserver', choices=['sqlserver', 'files'], help='Load the staged tables into SQL Server, or keep the staged files as the output and never connect to a DB server.')
+    parser.add_argument('--layout', type= str, required=False, action="store", default = 'wide', choices=['wide', 'long'], help='wide loads one table per ACS table in {year}_{geo} schemas. long unpivots every table into one partitioned fact table, [dbo].[Estimates], with one row per geography and variable.')
+    parser.add_argument('--optimize', type= str, required=False, action="store", choices=OPTIMIZE_MODES, help='After loading, give every table a clustered index on GEO_ID with page compression (rowstore), or a clustered columnstore index (columnstore), and update statistics.')
+    parser.add_argument('--optimize-workers', type= int, required=False, action="store", default = 2, help='The number of tables indexed at the same time with --optimize.')
+    parser.add_argument('--maxdop', type= int, required=False, action="store", default = 0, help='The maximum degree of parallelism of each index build with --optimize. 0 lets the server decide.')
+    parser.add_argument('--metrics', type= str, required=False, action="store", default = '/HostData/metrics.jsonl', help='JSON-lines file the time, bytes and rows of every stage of every table are appended to. A summary of the run is written to /HostData/RunSummary_{host}_{pid}_{start}.txt at the end. An empty string turns metrics off.')
+    parser.add_argument('--profile-table', type= str, required=False, action="store", help='Run the transform (parse, clean and staging write) and load stages of this table, ex. "B01001", under cProfile and tracemalloc. Profiles are saved to /HostData/profile_{year}_{geo}_{table}_{stage}.prof.')
+    parser.add_argument('--connections', type= int, required=False, action="store", default = 4, help='The maximum number of pooled connections kept open per database on the DB server.')
 
     # Print usage help statement
     if len(sys.argv) < 2:
@@ -375,11 +2379,57 @@ if __name__ == "__main__":
     
     # First line of the logs
     logging.info(f'Starting data pull for {args.year}')
+
+    # Every stage of every table is timed into the metrics file, and one table can be profiled
+    configure_metrics(path=args.metrics or None, profile_table=args.profile_table)
+
+    # Tables are staged in the chosen format, and either loaded into SQL Server or kept as files
+    if args.sink == 'sqlserver' and not (args.uid and args.pwd and args.ipaddress):
+        parser.error('--uid, --pwd and --ipaddress are required to load into SQL Server')
+    if args.sink == 'files' and args.incremental:
+        parser.error('--incremental compares against the tables loaded in SQL Server, it cannot be used with --sink files')
+    try:
+        configure_staging(format=args.staging, directory=args.staging_dir, sink=args.sink, layout=args.layout)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    # Every statement sent to SQL Server goes through a shared pool of long-lived connections
+    configure_pool(maxsize=args.connections)
+
+    # Census API requests share one keep-alive session, rate limited and retried on failure, and
+    # responses are kept in a local cache so reruns do not download them again
+    if args.offline and args.no_cache:
+        parser.error('--offline needs the response cache, it cannot be combined with --no-cache')
+    cache = None
+    if not args.no_cache:
+        cache = HttpCache(args.cache_dir, max_bytes=args.cache_size * 1024**2, ttl=args.cache_ttl * 3600, offline=args.offline)
+    configure_client(workers=args.workers, rate=args.rate, retries=args.retries, cache=cache)
+
+    # Rows per batch for tables that are loaded with INSERT rather than BULK INSERT
+    configure_loader(batch_size=args.batch_size)
+
+    # Tables move through download, clean and load stages that run concurrently
+    configure_pipeline(transform_workers=args.transform_workers, load_workers=args.load_workers, buffer=args.buffer, chunk_rows=args.chunk_rows)
     
+    # With --manifest, the (year, geo, table) units of the run are tracked in a shared SQLite file. Without --plan,
+    # this process joins a run that was already planned: it skips the database and schema set up and only works
+    # through units that are not done yet.
+    manifest = None
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    if args.plan and not args.manifest:
+        parser.error('--plan needs a --manifest to record the run in')
+    if args.manifest:
+        manifest = JobManifest(args.manifest, lease=args.lease, max_attempts=args.max_attempts)
+    joining = manifest is not None and not args.plan
+
     # If the user has included the --restart option in the command line, 
     # the db will not recreate, so it can be appended to rather than replacing old data.
-    if args.restart:
+    # An incremental refresh updates the existing db in place.
+    # Recreating the db drops every table the manifest's finished units loaded, so they are all loaded again.
+    if args.restart and not joining and not args.incremental and not files_only():
         create_db(ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd)
+        if manifest is not None:
+            manifest.reset()
     else:
         pass
     # Organizing what geographical rollups the user chose
@@ -390,35 +2440,71 @@ if __name__ == "__main__":
     if len(geos) == 0:
         geos = ["ZCTA", "STATE", "COUNTY", "BLOCKGROUP"]
 
-    if "BLOCKGROUP" in geos and len(geos) > 0:
-        
-        # Create census block group state mappings     
-        state_codes = [ 'AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA',
-            'HI', 'IA', 'ID', 'IL', 'IN', 'KS', 'KY', 'LA', 'MA', 'MD', 'ME',
-            'MI', 'MN', 'MO', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ', 'NM',
-            'NV', 'NY', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX',
-            'UT', 'VA', 'VT', 'WA', 'WI', 'WV', 'WY']
-
-        blockstring = 'BLOCKGROUP_'
+    # The table list is scraped once and saved, rather than once per geographical rollup
+    catalog = resolve_catalog('/HostData/TableCatalog.pkl', refresh=args.refresh_catalog)
 
-        state_geos = [f"{blockstring}{state}" for state in state_codes]
+    year1, year2 = year_split(args.year)
 
-        for f, rollup in product([create_schema, find_tables, get_acs_data], state_geos):
-            f(years=args.year, uid=args.uid, pwd=args.pwd, ipaddress=args.ipaddress, start=args.start, alone=args.alone, apikey=args.apikey, geo=rollup, cleanup=args.cleanup, restart=args.restart)
+    if not joining and not files_only():
+        # Table loads are recorded, so later incremental runs can tell which tables changed
+        create_load_history(ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd)
 
-        geos.remove("BLOCKGROUP")
-
-    if len(geos)>0:
-        # For each geographical rollup, execute create_schema first, then find_tables, then get_acs_data. All functions include the command line arguments.
-        for f, rollup in product([create_schema, find_tables, get_acs_data], geos):
-            f(years=args.year, uid=args.uid, pwd=args.pwd, ipaddress=args.ipaddress, start=args.start, alone=args.alone, apikey=args.apikey, geo=rollup, cleanup=args.cleanup, restart=args.restart)
-
-    # When the data pull is complete, write the logs to a csv file for easy reviewing
-    with open('/HostData/logging.log', 'r') as logfile, open('/HostData/LOGFILE.csv', 'w') as csvfile:
-        reader = csv.reader(logfile, delimiter='|')
-        writer = csv.writer(csvfile, delimiter=',',)
-        writer.writerow(['EventTime', 'Origin', 'Level', 'Message'])
-        writer.writerows(reader)
+        # For each geographical rollup, execute create_schema first, then load every TableLegend in one pass, then get_acs_data.
+        # The long layout has one fact table and its dimensions in dbo instead.
+        if long_layout():
+            create_long_tables(ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd)
+        else:
+            # Block groups of every state go into one table per year and B-table, partitioned by state
+            if "BLOCKGROUP" in geos:
+                create_state_partitions(ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd)
+            for rollup in geos:
+                create_schema(years=args.year, uid=args.uid, pwd=args.pwd, ipaddress=args.ipaddress, start=args.start, alone=args.alone, apikey=args.apikey, geo=rollup, cleanup=args.cleanup, restart=args.restart)
+
+    if not joining:
+        # With --sink files, the legend is only written to TableLegend.csv in the staging directory
+        schemas = ['dbo'] if long_layout() else [f'{year}_{rollup}' for rollup in geos for year in range(year1, year2)]
+        catalog.load_legend(schemas, ipaddress=args.ipaddress, uid=args.uid, pwd=args.pwd)
+
+    if manifest is not None and args.plan:
+        # Record every unit of the run, and load the variable labels, before any worker starts on the tables
+        units = plan_units(catalog, args.year, args.start, args.alone)
+        for rollup in geos:
+            manifest.add(rollup, units)
+            for year in range(year1, year2):
+                variablelabels(year, rollup, [table for y, table in units if y == year], args.ipaddress, args.uid, args.pwd)
+
+    if manifest is not None:
+        stop_keepalive = manifest.keepalive(worker)
+
+    for rollup in geos:
+        get_acs_data(years=args.year, uid=args.uid, pwd=args.pwd, ipaddress=args.ipaddress, start=args.start, alone=args.alone, apikey=args.apikey, geo=rollup, cleanup=args.cleanup, restart=args.restart, catalog=catalog, manifest=manifest, worker=worker, incremental=args.incremental)
+
+    # Index and compress the loaded tables. Workers that joined a manifest leave this to the planning process.
+    if args.optimize and not joining and not files_only() and not long_layout():
+        for rollup in geos:
+            for year in range(year1, year2):
+                optimize_schema(year, rollup, args.optimize, args.optimize_workers, args.maxdop, args.ipaddress, args.uid, args.pwd)
+
+    if manifest is not None:
+        stop_keepalive.set()
+        logging.info(f'Manifest {args.manifest}: ' + ', '.join(f'{count} {status}' for status, count in sorted(manifest.summary().items())))
+
+    # Close the pooled SQL Server connections
+    close_pools()
+    close_client()
+
+    # When the data pull is complete, write a summary of where the run spent its time for easy reviewing
+    if args.metrics:
+        # Workers can share a metrics file, so the summary covers this run only and is named after it
+        run = _metrics_settings['log'].run
+        record_metric('run', seconds=time.time() - _metrics_settings['log'].started, geos=geos, years=args.year)
+        close_metrics()
+        summary = summarize_metrics(args.metrics, run=run)
+        summary_path = f"/HostData/RunSummary_{run.replace(':', '_')}.txt"
+        with open(summary_path, 'w') as f:
+            f.write(summary + '\n')
+        print(summary)
+        logging.info(f'Run summary written to {summary_path}')
 
 
 # Example command line inputs, in order without instructions. 
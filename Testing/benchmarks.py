@@ -0,0 +1,758 @@
+#Agency: Center for Computational Biomedicine (CCB)
+#Project: Exposome Data Warehouse - American Community Survey 5 Year Estimates API Download - Benchmarks
+
+# Benchmarks for Code/download.py that run without network access.
+# A local mock of the Census API serves synthetic payloads with an artificial per-request latency.
+#
+# python3 Testing/benchmarks.py fetch --tables 40 --latency 0.2
+# python3 Testing/benchmarks.py parse --rows 33000 --variables 50
+# python3 Testing/benchmarks.py clean --rows 33000 --variables 50
+# python3 Testing/benchmarks.py staging --rows 33000 --variables 50
+# python3 Testing/benchmarks.py ddl --rows 33000 --variables 50 [--ipaddress 172.17.0.2 --uid sa --pwd ...]
+# python3 Testing/benchmarks.py e2e [--scenario zcta] [--staging native] [--scale 0.1] [--save-baseline]
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import download
+
+
+BLOCK_GROUP_COLUMNS = ('state', 'county', 'tract', 'block group')
+
+def synthetic_table(table, rows, variables, geo_columns=('state',), state=None, fraction='.5'):
+    # A payload shaped like the acs5 group() response: header row, then one row per geography.
+    # With a state, the rows are the block groups of that state. The margin of error of the first
+    # variable is whole in the first half of the rows and ends in fraction in the second half, so
+    # the column only turns fractional in later chunks of the table.
+    header = ['NAME']
+    for i in range(1, variables + 1):
+        header += [f'{table}_{i:03d}E', f'{table}_{i:03d}EA', f'{table}_{i:03d}M', f'{table}_{i:03d}MA']
+    header += ['GEO_ID'] + list(geo_columns)
+
+    data = [header]
+    for r in range(rows):
+        row = [f'ZCTA5 {r:05d}']
+        for i in range(1, variables + 1):
+            margin = str((r + i) % 900) + (fraction if i == 1 and r >= rows // 2 else '')
+            row += [str((r * 31 + i * 7) % 50000), None, margin, None]
+        if state is None:
+            row += [f'860Z200US{r:05d}'] + [f'{r % 100:02d}' for _ in geo_columns]
+        else:
+            row += [f'1500000US{state}{r:010d}', state, f'{r % 100:03d}', f'{r:06d}', str(r % 10)]
+        data.append(row)
+    return data
+
+
+def synthetic_variables(tables, variables):
+    # The variables.json catalog: one entry per estimate, with its margin of error and annotations as attributes
+    catalog = {'NAME': {'label': 'Geographic Area Name', 'concept': 'Geography', 'predicateType': 'string', 'group': 'N/A'}}
+    for table in tables:
+        for i in range(1, variables + 1):
+            name = f'{table}_{i:03d}'
+            catalog[name + 'E'] = {'label': f'Estimate!!Total:!!Item {i}', 'concept': f'Synthetic {table}', 'predicateType': 'int',
+                                   'group': table, 'attributes': f'{name}M,{name}EA,{name}MA'}
+    return {'variables': catalog}
+
+
+def synthetic_table_list(tables):
+    # The ACS table list spreadsheet find_tables downloads: the B-tables, plus a table of another type
+    legend = pd.DataFrame({'Table ID': tables + ['C00001'],
+                           'Table Title': [f'Synthetic {table}' for table in tables] + ['Collapsed table'],
+                           'Table Universe': ['Universe: Total population'] * (len(tables) + 1),
+                           'Year': 2019})
+    content = BytesIO()
+    legend.to_excel(content, index=False, engine='openpyxl')
+    return content.getvalue()
+
+
+# Payloads are generated once per shape for this table and state, and the names swapped in per request
+TEMPLATE_TABLE, TEMPLATE_STATE, TEMPLATE_FRACTION = 'B99999', '@@', '@~'
+
+# Block groups of states from this FIPS code on have the fractional margins of error, the others only
+# whole ones, so the column turns fractional in later state slices of a table
+FRACTION_FROM_STATE = '30'
+
+class MockCensus:
+    # Serves /data/{year}/acs/acs5 and /data/{year}/acs/acs5/variables.json on localhost, and the ACS
+    # table list at table_list_url
+
+    def __init__(self, rows=100, variables=20, latency=0.0, tables=None):
+        self.rows = rows
+        self.variables = variables
+        self.tables = tables or [f'B{i:05d}' for i in range(1, 51)]
+        self.latency = latency
+        self.requests = 0
+        self.templates = {}
+        self.lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                mock.requests += 1
+                time.sleep(mock.latency)
+                url = urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+
+                if parts[-1] == 'variables.json':
+                    body, kind = json.dumps(synthetic_variables(mock.tables, mock.variables)).encode('utf-8'), 'application/json'
+                elif parts[-1] == 'acs5':
+                    query = parse_qs(url.query)
+                    if 'group(' not in query['get'][0]:
+                        # The state list the block group FIPS codes are checked against
+                        states = [['NAME', 'state']] + [[name, code] for code, name in download.STATES.values()] + [['Puerto Rico', '72']]
+                        body = json.dumps(states).encode('utf-8')
+                    else:
+                        table = query['get'][0].split('group(')[1].rstrip(')')
+                        state = None
+                        if query['for'][0].startswith('block group'):
+                            state = query['in'][0].split()[0].split(':')[1]
+                        body = mock.payload(table, state)
+                    kind = 'application/json'
+                elif parts[-1] == 'table_list.html':
+                    body, kind = f'<html><body><a name="2019 ACS Table List" href="{mock.root}/table_list.xlsx">2019</a></body></html>'.encode('utf-8'), 'text/html'
+                elif parts[-1] == 'table_list.xlsx':
+                    body, kind = synthetic_table_list(mock.tables), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.root = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.url = f'{self.root}/data'
+        self.table_list_url = f'{self.root}/table_list.html'
+
+    def payload(self, table, state=None):
+        # The group() response of a table, for the block groups of a state if one is given
+        key = state is not None
+        with self.lock:
+            if key not in self.templates:
+                data = synthetic_table(TEMPLATE_TABLE, self.rows, self.variables, BLOCK_GROUP_COLUMNS, state=TEMPLATE_STATE, fraction=TEMPLATE_FRACTION) if key else \
+                       synthetic_table(TEMPLATE_TABLE, self.rows, self.variables)
+                self.templates[key] = json.dumps(data).encode('utf-8')
+        body = self.templates[key].replace(TEMPLATE_TABLE.encode(), table.encode())
+        if not key:
+            return body
+        fraction = b'.5' if state >= FRACTION_FROM_STATE else b''
+        return body.replace(TEMPLATE_STATE.encode(), state.encode()).replace(TEMPLATE_FRACTION.encode(), fraction)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_fetch(args):
+    # Serial requests.get (the original download loop) against the concurrent, rate limited client
+    tables = [f'B{i:05d}' for i in range(1, args.tables + 1)]
+
+    with MockCensus(rows=args.rows, variables=args.variables, latency=args.latency) as mock:
+        download.CENSUS_API = mock.url
+        urls = [download.acs_url(2020, table, 'state:*', 'KEY') for table in tables]
+
+        start = time.perf_counter()
+        for url in urls:
+            requests.get(url, timeout=100).json()
+        serial = time.perf_counter() - start
+
+        client = download.CensusClient(workers=args.workers, rate=args.rate)
+        start = time.perf_counter()
+        for _, result, error in client.map(lambda url: client.get(url).json(), urls):
+            if error is not None:
+                raise error
+        concurrent = time.perf_counter() - start
+        client.close()
+
+    print(f'{len(urls)} requests, {args.latency}s latency, {args.workers} workers, {args.rate} req/s limit')
+    print(f'serial:     {serial:.2f}s ({len(urls) / serial:.1f} req/s)')
+    print(f'concurrent: {concurrent:.2f}s ({len(urls) / concurrent:.1f} req/s)')
+
+
+def measure(fn):
+    # Wall time of one call, and the peak traced memory of a second call (tracing slows python code down,
+    # so the two are measured separately)
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_parse(args):
+    # response.json() + DataFrame (the original transform) against the streaming, typed column parser
+    content = json.dumps(synthetic_table('B01001', args.rows, args.variables)).encode('utf-8')
+
+    def materialized():
+        data = json.loads(content)
+        return pd.DataFrame(data[1:], columns=data[0])
+
+    def streamed():
+        return next(download.stream_frames(download.iter_chunks(content)))
+
+    def chunked():
+        rows = 0
+        for part in download.stream_frames(download.iter_chunks(content), args.chunk_rows):
+            rows += len(part)
+        return rows
+
+    print(f'{args.rows} rows x {args.variables * 4 + 3} columns, {len(content) / 1024**2:.1f} MB payload')
+    for name, fn in (('json + DataFrame', materialized), ('streaming', streamed), (f'streaming, {args.chunk_rows} row chunks', chunked)):
+        _, seconds, peak = measure(fn)
+        print(f'{name:32} {seconds:6.2f}s  peak {peak / 1024**2:7.1f} MB')
+
+
+def legacy_clean(df):
+    # clean() as it was before it targeted columns: regex replace and fillna over every cell
+    df = df.replace('ZCTA5 ', '', regex=True)
+    df.fillna("",inplace=True)
+    df = df.loc[:,~df.columns.duplicated()]
+    df.columns = df.columns.str.replace(' ', '')
+    return df
+
+
+def bench_clean(args):
+    # The whole frame clean against the column targeted one, on the raw text frame of the original transform
+    # and on the typed frame from the streaming parser
+    data = synthetic_table('B01001', args.rows, args.variables)
+    for row in data[1::97]:
+        row[1] = str(download.CENSUS_SENTINELS[len(row[0]) % len(download.CENSUS_SENTINELS)])
+    raw = pd.DataFrame(data[1:], columns=data[0])
+    typed = next(download.stream_frames(download.iter_chunks(json.dumps(data).encode('utf-8'))))
+
+    print(f'{args.rows} rows x {len(data[0])} columns, best of {args.repeat}')
+    for name, fn, frame in (('legacy clean, text frame', legacy_clean, raw), ('clean, text frame', download.clean, raw),
+                            ('legacy clean, typed frame', legacy_clean, typed), ('clean, typed frame', download.clean, typed)):
+        seconds = []
+        for _ in range(args.repeat):
+            copy = frame.copy()
+            start = time.perf_counter()
+            fn(copy)
+            seconds.append(time.perf_counter() - start)
+        print(f'{name:32} {min(seconds):6.3f}s')
+
+
+def bench_staging(args):
+    # Write time, size on disk and read back time of one cleaned table in each staging format
+    content = json.dumps(synthetic_table('B01001', args.rows, args.variables)).encode('utf-8')
+    df = download.clean(next(download.stream_frames(download.iter_chunks(content))))
+    directory = tempfile.mkdtemp()
+
+    print(f'{args.rows} rows x {len(df.columns)} columns')
+    try:
+        for name, cls in download.STAGING_FORMATS.items():
+            if name == 'parquet' and download.pyarrow is None:
+                print(f'{name:10} skipped, pyarrow is not installed')
+                continue
+            staged = cls(os.path.join(directory, 'B01001' + cls.extension))
+            start = time.perf_counter()
+            staged.write(df)
+            written = time.perf_counter() - start
+            if os.path.isdir(staged.path):
+                size = sum(os.path.getsize(os.path.join(staged.path, f)) for f in os.listdir(staged.path))
+            else:
+                size = os.path.getsize(staged.path)
+            start = time.perf_counter()
+            for _ in staged.frames(args.rows):
+                pass
+            read = time.perf_counter() - start
+            print(f'{name:10} write {written:6.2f}s  {size / 1024**2:7.1f} MB  read back {read:6.2f}s')
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_create(df, target):
+    # acs_ETL's CREATE TABLE before typed schemas: get_schema output with TEXT patched to INTEGER for
+    # estimate and margin of error columns, and to VARCHAR(MAX) for everything else
+    create = pd.io.sql.get_schema(df, target)
+    create = create.replace('"','',2)
+    create = create.replace("TEXT", "|")
+    create = create.replace("|", "VARCHAR(MAX)",1)
+    create = create.split(",")
+    for i in range(1, len(create)-1):
+        if create[i][-4] == "E" or create[i][-4] == "M":
+            create[i] = create[i].replace("|", "INTEGER")
+        else:
+            create[i] = create[i].replace("|", "VARCHAR(MAX)")
+    create = ','.join(create)
+    return create.replace("|", "VARCHAR(MAX)")
+
+
+def row_bytes(df, types):
+    # Rough in-row size of a row: fixed width types take their width even when NULL, variable width
+    # types their length plus a two byte offset, and every column a bit in the NULL bitmap
+    widths = {'INT': 4, 'INTEGER': 4, 'REAL': 4, 'BIGINT': 8, 'FLOAT': 8}
+    size = 4 + (len(types) + 7) // 8
+    for col, kind in zip(df.columns, types):
+        if kind in widths:
+            size += widths[kind]
+        elif kind.startswith('CHAR('):
+            size += int(kind[5:-1])
+        else:
+            size += 2 + df[col].dropna().astype(str).str.len().mean() if df[col].notna().any() else 0
+    return size
+
+
+def bench_ddl(args):
+    # Declared types and estimated row size of the legacy and typed CREATE TABLE for one table. Given a
+    # DB server, both are also created and loaded, and their space used and scan time compared.
+    content = json.dumps(synthetic_table('B01001', args.rows, args.variables)).encode('utf-8')
+    df = download.clean(next(download.stream_frames(download.iter_chunks(content))))
+    profile = download.TableProfile()
+    profile.update(df)
+    schema = download.column_types(profile)
+
+    tables = {'legacy': legacy_create(df, '[dbo].[bench_legacy_ddl]'),
+              'typed': download.create_statement('[dbo].[bench_typed_ddl]', schema)}
+    legacy = [line.strip().split(' ', 1)[1].rstrip(',').strip() for line in tables['legacy'].splitlines()[1:-1]]
+    typed = [kind for _, kind, _ in schema]
+
+    print(f'{args.rows} rows x {len(df.columns)} columns')
+    for name, types in (('legacy', legacy), ('typed', typed)):
+        counts = pd.Series(types).value_counts()
+        print(f'{name:8} ~{row_bytes(df, types):6.0f} bytes/row  ' + ', '.join(f'{count} {kind}' for kind, count in counts.items()))
+
+    if not args.ipaddress:
+        return
+
+    # Both tables go in the dbo schema of the warehouse database, and are dropped afterwards.
+    # The scan groups by the state code and sums the estimates, as queries against the warehouse do.
+    estimates = [col for col in df.columns if download.ESTIMATE_COLUMN.match(col)]
+    scan = 'SELECT [state], COUNT_BIG(*), ' + ', '.join(f'SUM(CAST([{col}] AS BIGINT))' for col in estimates) + ' FROM {table} GROUP BY [state];'
+    for name, create in tables.items():
+        table = f'[dbo].[bench_{name}_ddl]'
+        download.sql_server(f"IF OBJECT_ID('{table}') IS NOT NULL DROP TABLE {table};", 'AmericanCommunitySurvey', args.ipaddress, args.uid, args.pwd)
+        download.sql_server(create, 'AmericanCommunitySurvey', args.ipaddress, args.uid, args.pwd)
+        download.insert_rows(df, table, args.ipaddress, args.uid, args.pwd, batch_size=args.batch_size)
+        seconds = []
+        with download.sql_cursor('AmericanCommunitySurvey', args.ipaddress, args.uid, args.pwd) as cursor:
+            cursor.execute(f"EXEC sp_spaceused '{table}';")
+            used = cursor.fetchall()[0]
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                cursor.execute(scan.format(table=table))
+                cursor.fetchall()
+                seconds.append(time.perf_counter() - start)
+        print(f'{name:8} reserved {used[2]:>12}  data {used[3]:>12}  scan {min(seconds):6.3f}s')
+        download.sql_server(f'DROP TABLE {table};', 'AmericanCommunitySurvey', args.ipaddress, args.uid, args.pwd)
+
+
+# End to end scenarios
+# Each scenario runs a whole download the way the command line does: find_tables against the mock table
+# list, variablelabels, then get_acs_data (download, parse, clean, stage and acs_ETL) for every table of
+# one year and geography, with the metrics of every stage recorded. Scenario sizes are the real shapes:
+#  zcta        33,120 ZCTAs, 50 variables (203 columns)
+#  blockgroup  51 state slices of 4,750 block groups, about 242,000 rows a table, 20 variables
+#  wide        3,222 counties, 300 variables (1,203 columns), loaded through the sparse column path
+# The database is LocalServer, which accepts the T-SQL and reads the staged files as SQL Server would,
+# so the results cover this script's side of the load, not the server's. After the run, the first table
+# is read back from what was loaded and checked against the payloads the mock served: the row count, NAME
+# with its leading zeros, and a margin of error that only turns fractional in later parts of the table.
+# A scenario whose values do not round trip fails like a regression. Each scenario runs in a fresh
+# process, so its peak memory is its own. Results are compared with benchmark_baseline.json; baselines
+# depend on the machine, so save new ones (--save-baseline) on the machine that runs the comparison.
+
+SCENARIOS = {
+    'zcta': {'geo': 'ZCTA', 'rows': 33120, 'variables': 50, 'tables': 4},
+    'blockgroup': {'geo': 'BLOCKGROUP', 'rows': 4750, 'variables': 20, 'tables': 2},
+    'wide': {'geo': 'COUNTY', 'rows': 3222, 'variables': 300, 'tables': 2},
+}
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+class LocalServer:
+    # A stand-in for the SQL Server connection, plugged into download's connection pool. Statements are
+    # counted by kind. BULK INSERT copies the staged file into directory, where the server keeps the
+    # table's rows, and INSERT batches are kept as they were sent. CREATE TABLE empties a table. Queries
+    # return no rows. table() reads the rows of a table back, after the run.
+
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.statements = {}
+        self.bulk_bytes = 0
+        self.inserted_rows = 0
+        self.files = 0
+        # Target -> what was loaded into it, in order: ('csv', copy), ('native', copy, format file copy),
+        # ('rows', columns, rows) from executemany, or ('values', columns, VALUES lists) from INSERT
+        self.tables = {}
+
+    def count(self, kind, rows=0, size=0):
+        with self.lock:
+            self.statements[kind] = self.statements.get(kind, 0) + 1
+            self.inserted_rows += rows
+            self.bulk_bytes += size
+
+    def connect(self, db, ipaddress, uid, pwd):
+        return LocalConnection(self)
+
+    def create(self, target):
+        with self.lock:
+            self.tables[target] = []
+
+    def keep(self, target, load):
+        with self.lock:
+            self.tables.setdefault(target, []).append(load)
+
+    def copy(self, path):
+        # A copy of a staged file, which download deletes once it is loaded
+        with self.lock:
+            self.files += 1
+            copy = os.path.join(self.directory, f'{self.files:05d}_{os.path.basename(path)}')
+        shutil.copyfile(path, copy)
+        return copy
+
+    def table(self, target):
+        # Every row loaded into a table, as SQL Server would read them from each source: the csv text,
+        # the native fields, and the values bound or quoted in INSERT statements
+        frames = []
+        for load in self.tables.get(target, []):
+            if load[0] == 'csv':
+                frames.append(pd.read_csv(load[1], dtype=str, keep_default_na=False, na_values=['']))
+            elif load[0] == 'native':
+                staged = download.NativeStaging(load[1])
+                with open(load[2]) as f:
+                    fields = [line.split('\t') for line in f.read().splitlines()[2:]]
+                staged.columns, staged.types = [field[6] for field in fields], [field[1] for field in fields]
+                frames += list(staged.frames(100000))
+            elif load[0] == 'rows':
+                frames.append(pd.DataFrame(load[2], columns=load[1], dtype=object))
+            else:
+                frames.append(pd.DataFrame(parse_values(load[2]), columns=load[1], dtype=object))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+# The literals download.sql_literal writes, and the parentheses around each row of a VALUES list
+SQL_TOKEN = re.compile(r"NULL|N'(?:[^']|'')*'|[()]|[^,\s()';]+")
+
+def parse_values(text):
+    # The rows of a multi-row VALUES list
+    rows, row = [], None
+    for token in SQL_TOKEN.findall(text):
+        if token == '(':
+            row = []
+        elif token == ')':
+            rows.append(row)
+        elif token == 'NULL':
+            row.append(None)
+        elif token.startswith("N'"):
+            row.append(token[2:-1].replace("''", "'"))
+        else:
+            row.append(float(token) if any(c in token for c in '.eEn') else int(token))
+    return rows
+
+
+def insert_target(query):
+    # The table and columns of an INSERT INTO {target} ([col], ...) VALUES statement
+    match = re.match(r"\s*INSERT INTO (\S+) \((.*?)\) VALUES ", query, re.S)
+    if match is None:
+        return None, None, None
+    return match.group(1), [col.strip()[1:-1] for col in match.group(2).split(',')], query[match.end():]
+
+
+class LocalConnection:
+
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self):
+        return LocalCursor(self.server)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalCursor:
+    fast_executemany = False
+
+    def __init__(self, server):
+        self.server = server
+
+    def execute(self, query, params=None):
+        statement = query.lstrip().split(None, 2)
+        kind = ' '.join(statement[:2]).upper() if statement[0].upper() in ('CREATE', 'BULK', 'INSERT') else statement[0].upper()
+        if kind == 'CREATE TABLE':
+            self.server.create(statement[2].split(None, 1)[0])
+        size = 0
+        for target, path, options in re.findall(r"BULK INSERT (\S+?) ?FROM '([^']+)' WITH \(([^)]*)\)", query):
+            # Read the staged file through, like the server does, and keep it as the table's rows
+            copy = self.server.copy(path)
+            size += os.path.getsize(copy)
+            formatfile = re.search(r"FORMATFILE = '([^']+)'", options)
+            self.server.keep(target, ('native', copy, self.server.copy(formatfile.group(1))) if formatfile else ('csv', copy))
+        rows = 0
+        if kind == 'INSERT INTO':
+            rows = query.count('),\n(') + 1
+            target, columns, values = insert_target(query)
+            if target is not None:
+                self.server.keep(target, ('values', columns, values))
+        self.server.count(kind, rows=rows, size=size)
+
+    def executemany(self, query, rows):
+        target, columns, _ = insert_target(query)
+        self.server.keep(target, ('rows', columns, rows))
+        self.server.count('INSERT INTO', rows=len(rows))
+
+    def fetchone(self):
+        return (0,)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+def round_trip(server, scenario, year, table):
+    # Problems with the rows of a loaded table, compared with what the mock served for it: the row count,
+    # the NAME text with its leading zeros, an estimate, and the margin of error that is whole in the
+    # first rows and states of the table and fractional in later ones
+    geo, rows = scenario['geo'], scenario['rows']
+    df = server.table(f'[AmericanCommunitySurvey].[{year}_{geo}].[{table}]')
+    codes = sorted(code for code, _ in download.STATES.values())
+    scopes = [f'block%20group:*&in=state:{code}%20county:*' for code in (codes[0], codes[-1])] if geo == 'BLOCKGROUP' else ['county:*']
+    states = len(codes) if geo == 'BLOCKGROUP' else 1
+    fractional = (rows - rows // 2) * (sum(code >= FRACTION_FROM_STATE for code in codes) if geo == 'BLOCKGROUP' else 1)
+    estimate, margin = f'{table}_002E', f'{table}_001M'
+
+    problems = []
+    if len(df) != rows * states:
+        problems.append(f'{len(df):,} rows loaded, {rows * states:,} served')
+    if len(df) == 0 or margin not in df.columns:
+        return problems + [f'no {margin} column loaded']
+    loaded_fractional = int((pd.to_numeric(df[margin]) % 1 != 0).sum())
+    if loaded_fractional != fractional:
+        problems.append(f'{loaded_fractional:,} fractional values of {margin} loaded, {fractional:,} served')
+
+    loaded = df.set_index('GEO_ID')
+    for scope in scopes:
+        header, *served = requests.get(download.acs_url(year, table, scope, 'KEY')).json()
+        for r in sorted({min(1, rows - 1), rows - 1}):
+            row = dict(zip(header, served[r]))
+            if row['GEO_ID'] not in loaded.index:
+                problems.append(f"{row['GEO_ID']} not loaded")
+                continue
+            values = loaded.loc[row['GEO_ID']]
+            name = row['NAME'].replace('ZCTA5 ', '')
+            if not isinstance(values['NAME'], str) or values['NAME'] != name:
+                problems.append(f"{row['GEO_ID']} NAME {values['NAME']!r}, served {name!r}")
+            for col in (estimate, margin):
+                if pd.isna(values[col]) or float(values[col]) != float(row[col]):
+                    problems.append(f"{row['GEO_ID']} {col} {values[col]!r}, served {row[col]!r}")
+    return problems
+
+
+def run_scenario(name, scenario, mock_root, options):
+    # Run one scenario against the mock at mock_root, in a fresh process. Returns its results.
+    directory = tempfile.mkdtemp()
+    try:
+        download.CENSUS_API = f'{mock_root}/data'
+        download.TABLE_LIST_URL = f'{mock_root}/table_list.html'
+        server = LocalServer(os.path.join(directory, 'server'))
+        os.makedirs(server.directory)
+        download.configure_pool(backend=server.connect, maxsize=options['connections'])
+        download.configure_client(workers=options['workers'], rate=options['rate'])
+        download.configure_staging(format=options['staging'], directory=directory + '/')
+        download.configure_pipeline(chunk_rows=options['chunk_rows'] or None)
+        metrics = os.path.join(directory, 'metrics.jsonl')
+        download.configure_metrics(path=metrics)
+        geo, year = scenario['geo'], '2021'
+        login = dict(ipaddress='localhost', uid='bench', pwd='bench')
+        steps = {}
+
+        start = time.perf_counter()
+        catalog = download.find_tables()
+        tables = list(catalog)
+        steps['find_tables'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if geo == 'BLOCKGROUP':
+            download.create_state_partitions(**login)
+        download.create_schema(year, login['uid'], login['pwd'], login['ipaddress'], tables[0], True, 'KEY', geo, False, True)
+        catalog.load_legend([f'{year}_{geo}'], **login)
+        download.variablelabels(year, geo, tables, **login)
+        steps['setup'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        download.get_acs_data(year, login['uid'], login['pwd'], login['ipaddress'], tables[0], True, 'KEY', geo, False, True, catalog)
+        steps['get_acs_data'] = time.perf_counter() - start
+        download.close_metrics()
+        download.close_pools()
+        download.close_client()
+
+        with open(metrics) as f:
+            entries = [json.loads(line) for line in f]
+        stages = {}
+        for entry in entries:
+            stages[entry['stage']] = stages.get(entry['stage'], 0.0) + entry.get('seconds', 0.0)
+        loads = [entry for entry in entries if entry['stage'] == 'load']
+        rows = sum(entry['rows'] for entry in loads)
+        payload = sum(entry.get('bytes', 0) for entry in entries if entry['stage'] == 'fetch')
+        seconds = steps['get_acs_data']
+        peak = round(download.peak_rss_mb())
+        # Checked after the peak memory is taken, as reading the tables back is not part of the run
+        problems = round_trip(server, scenario, year, tables[0])
+        return {'scenario': name, 'geo': geo, 'staging': options['staging'], 'scale': options['scale'],
+                'tables': len(tables), 'loaded': len(loads), 'rows': rows, 'columns': max((entry['columns'] for entry in loads), default=0),
+                'payload_mb': round(payload / 1024**2, 1), 'seconds': round(seconds, 2),
+                'rows_per_s': round(rows / seconds), 'mb_per_s': round(payload / 1024**2 / seconds, 2),
+                'peak_rss_mb': peak, 'steps': {k: round(v, 3) for k, v in steps.items()},
+                'stages': {k: round(v, 3) for k, v in stages.items()}, 'statements': server.statements,
+                'inserted_rows': server.inserted_rows, 'bulk_mb': round(server.bulk_bytes / 1024**2, 1), 'round_trip': problems}
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(result, baseline, tolerance):
+    # Regressions of a result against its baseline: throughput down or peak memory up by more than tolerance
+    problems = []
+    if result['rows_per_s'] < baseline['rows_per_s'] * (1 - tolerance):
+        problems.append(f"throughput {result['rows_per_s']:,} rows/s, baseline {baseline['rows_per_s']:,}")
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        problems.append(f"peak memory {result['peak_rss_mb']:,} MB, baseline {baseline['peak_rss_mb']:,}")
+    return problems
+
+
+def bench_e2e(args):
+    # Run the scenarios, compare them with the saved baseline of the same staging format and scale, and
+    # optionally save the results as the new baseline. Exits with status 1 if any scenario regressed.
+    names = args.scenarios or list(SCENARIOS)
+    options = {'staging': args.staging, 'scale': args.scale, 'workers': args.workers, 'rate': args.rate,
+               'connections': args.connections, 'chunk_rows': args.chunk_rows}
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    results, regressions = {}, {}
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        scenario = dict(SCENARIOS[name])
+        scenario['rows'] = max(1, int(scenario['rows'] * args.scale))
+        tables = [f'B{i:05d}' for i in range(1, scenario['tables'] + 1)]
+        with MockCensus(rows=scenario['rows'], variables=scenario['variables'], latency=args.latency, tables=tables) as mock:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_scenario, (name, scenario, mock.root, options))
+
+        key = f"{name}/{args.staging}/{args.scale:g}"
+        results[key] = result
+        print(f"{key:28} {result['loaded']}/{result['tables']} tables  {result['rows']:>9,} rows x {result['columns']:>4} columns  "
+              f"{result['seconds']:7.2f}s  {result['rows_per_s']:>8,} rows/s  {result['mb_per_s']:6.2f} MB/s  peak {result['peak_rss_mb']:>5,} MB")
+        print(' ' * 29 + '  '.join(f'{stage} {seconds:.2f}s' for stage, seconds in result['stages'].items()))
+        if result['loaded'] != result['tables']:
+            regressions[key] = [f"only {result['loaded']} of {result['tables']} tables loaded"]
+        elif result['round_trip']:
+            regressions[key] = ['round trip: ' + problem for problem in result['round_trip']]
+        elif key in baselines:
+            problems = compare(result, baselines[key], args.tolerance)
+            if problems:
+                regressions[key] = problems
+        else:
+            print(' ' * 29 + 'no baseline')
+
+    for key, problems in regressions.items():
+        print(f'REGRESSION {key}: ' + '; '.join(problems))
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    fetch = subparsers.add_parser('fetch', help='Serial vs. concurrent Census API downloads against the mock server.')
+    fetch.add_argument('--tables', type=int, default=40, help='Number of tables to request.')
+    fetch.add_argument('--rows', type=int, default=100, help='Geography rows per synthetic table.')
+    fetch.add_argument('--variables', type=int, default=20, help='Variables per synthetic table (four columns each).')
+    fetch.add_argument('--latency', type=float, default=0.2, help='Seconds the mock server waits before answering.')
+    fetch.add_argument('--workers', type=int, default=8, help='Requests in flight for the concurrent client.')
+    fetch.add_argument('--rate', type=float, default=50, help='Requests per second limit for the concurrent client.')
+    fetch.set_defaults(run=bench_fetch)
+
+    parse = subparsers.add_parser('parse', help='Peak memory and time of parsing one large payload.')
+    parse.add_argument('--rows', type=int, default=33000, help='Geography rows in the payload (ZCTA is about 33,000).')
+    parse.add_argument('--variables', type=int, default=50, help='Variables in the table (four columns each).')
+    parse.add_argument('--chunk-rows', type=int, default=5000, help='Rows per chunk for the chunked run.')
+    parse.set_defaults(run=bench_parse)
+
+    clean = subparsers.add_parser('clean', help='Time of clean() on a ZCTA sized table, before and after it targeted columns.')
+    clean.add_argument('--rows', type=int, default=33000, help='Geography rows in the table (ZCTA is about 33,000).')
+    clean.add_argument('--variables', type=int, default=50, help='Variables in the table (four columns each).')
+    clean.add_argument('--repeat', type=int, default=5, help='Runs of each variant; the fastest is reported.')
+    clean.set_defaults(run=bench_clean)
+
+    staging = subparsers.add_parser('staging', help='Write time, size and read back time of each staging format.')
+    staging.add_argument('--rows', type=int, default=33000, help='Geography rows in the table (ZCTA is about 33,000).')
+    staging.add_argument('--variables', type=int, default=50, help='Variables in the table (four columns each).')
+    staging.set_defaults(run=bench_staging)
+
+    ddl = subparsers.add_parser('ddl', help='Row size, space used and scan time of a table created with the legacy and the typed DDL.')
+    ddl.add_argument('--rows', type=int, default=33000, help='Geography rows in the table (ZCTA is about 33,000).')
+    ddl.add_argument('--variables', type=int, default=50, help='Variables in the table (four columns each).')
+    ddl.add_argument('--ipaddress', type=str, help='DB server to load both tables into. Without it only the estimated row sizes are shown.')
+    ddl.add_argument('--uid', type=str, help='User ID for the DB server.')
+    ddl.add_argument('--pwd', type=str, help='Password for the DB server.')
+    ddl.add_argument('--repeat', type=int, default=5, help='Scans of each table; the fastest is reported.')
+    ddl.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT batch when loading the tables.')
+    ddl.set_defaults(run=bench_ddl)
+
+    e2e = subparsers.add_parser('e2e', help='Whole runs of realistic tables against the mock API and a local DB stand-in, compared with the saved baseline.')
+    e2e.add_argument('--scenario', dest='scenarios', action='append', choices=list(SCENARIOS), help='A scenario to run; repeat the option for several. Default: all of them.')
+    e2e.add_argument('--staging', type=str, default='csv', choices=sorted(download.STAGING_FORMATS), help='Staging format of the run.')
+    e2e.add_argument('--scale', type=float, default=1.0, help='Multiplies the rows of every scenario, ex. 0.1 for a quick run. Baselines are kept per scale.')
+    e2e.add_argument('--latency', type=float, default=0.0, help='Seconds the mock server waits before answering.')
+    e2e.add_argument('--workers', type=int, default=8, help='Census API requests in flight.')
+    e2e.add_argument('--rate', type=float, default=1000, help='Census API requests per second limit. High by default, to measure the ingest path rather than the rate limit.')
+    e2e.add_argument('--connections', type=int, default=4, help='Pooled connections to the DB stand-in.')
+    e2e.add_argument('--chunk-rows', type=int, default=0, help='Parse and stage tables in chunks of this many rows. 0 processes each table in one piece.')
+    e2e.add_argument('--baseline', type=str, default=BASELINE, help='JSON file of baseline results to compare with.')
+    e2e.add_argument('--tolerance', type=float, default=0.25, help='Fraction throughput may drop, or peak memory grow, before a scenario counts as a regression.')
+    e2e.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline of these scenarios.')
+    e2e.set_defaults(run=bench_e2e)
+
+    args = parser.parse_args()
+    args.run(args)